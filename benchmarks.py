@@ -0,0 +1,172 @@
+#Offline benchmarks of the raster and planning hot paths on synthetic data
+#Generates HyP3-like vertical displacement stacks, site polygons and scene lists, times each hot path and records the
+#throughput and peak Python/numpy memory (tracemalloc, gdal's own allocations are not counted) to a json history.
+#Every run is compared with the last run of the same size so regressions show up before production runs.
+#usage: python benchmarks.py --size small --history benchmark_history.json
+import argparse
+import json
+import os
+import sqlite3
+import subprocess
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+import functions
+from functions import np, pd, gpd, rio
+
+#sizes of the synthetic data: dates in the stack, raster width and height, number of sites and of scenes
+SIZES = {'small':{'dates':20,'width':400,'height':400,'sites':5,'scenes':300},
+         'medium':{'dates':60,'width':1200,'height':1200,'sites':25,'scenes':3000},
+         'large':{'dates':150,'width':3000,'height':3000,'sites':100,'scenes':10000}}
+
+#projected crs of the synthetic rasters (UTM 15N like the Louisiana sites) and pixel size in meters
+CRS = 'EPSG:32615'
+PIXEL = 80.0
+ORIGIN = (700000.0,3350000.0)
+
+
+#Writes a stack of HyP3-like vert disp tifs, one product folder per date, with a slowly subsiding signal, noise and nodata edges
+#folder:str, dates:int, width:int, height:int, profile:dict (extra rasterio creation options)
+def make_stack(folder,dates,width,height,profile=None):
+    rng = np.random.default_rng(0)
+    transform = rio.transform.from_origin(ORIGIN[0],ORIGIN[1],PIXEL,PIXEL)
+    yy, xx = np.mgrid[0:height,0:width]
+    bowl = -0.02*np.exp(-((xx-width/2)**2+(yy-height/2)**2)/(2*(width/6)**2))
+    paths = []
+    start = datetime(2017,1,1)
+    for x in range(dates):
+        day = start + timedelta(days=12*x)
+        name = f"S1AA_{day:%Y%m%d}T000000_{day+timedelta(days=12):%Y%m%d}T000000_VVP012_INT80_G_ueF_{x:04X}"
+        os.makedirs(os.path.join(folder,name),exist_ok=True)
+        data = (bowl + rng.normal(0,0.005,(height,width))).astype('float32')
+        data[:, :x % 7] = 0 #products do not all cover the same extent
+        path = os.path.join(folder,name,name+'_vert_disp.tif')
+        options = dict(driver='GTiff',width=width,height=height,count=1,dtype='float32',crs=CRS,transform=transform,nodata=0)
+        options.update(profile or {})
+        with rio.open(path,'w',**options) as dst:
+            dst.write(data,1)
+        paths.append(path)
+    return paths
+
+#Random rectangular site polygons inside the stack bounds with a Name and enrichment Date, like the project shapefiles
+def make_sites(count,width,height):
+    rng = np.random.default_rng(1)
+    sites = []
+    for x in range(count):
+        size = rng.uniform(5,40)*PIXEL
+        left = ORIGIN[0] + rng.uniform(0.1,0.8)*width*PIXEL
+        top = ORIGIN[1] - rng.uniform(0.1,0.8)*height*PIXEL
+        sites.append(functions.box(left,top-size,left+size,top))
+    return gpd.GeoDataFrame({'Name':[f"SITE{x}" for x in range(count)],'Date':['2017-07-01']*count},geometry=sites,crs=CRS)
+
+#Scene list like get_scene_name returns: several paths and frames with a scene every 12 days
+def make_scenes(count):
+    rows = []
+    for x in range(count):
+        track = x % 5
+        day = datetime(2016,1,1) + timedelta(days=12*(x//5))
+        rows.append((day.strftime('%Y-%m-%dT%H:%M:%S.000000Z'),f"S1A_IW_SLC__1SDV_{day:%Y%m%d}T000000_{x:06d}",500+track,100+track,''))
+    return pd.DataFrame(rows,columns=['Dates','SceneNames','Frames','Paths','Urls'])
+
+#Runs fn once and returns its time, throughput (items per second) and peak traced memory
+def measure(name,fn,items):
+    tracemalloc.start()
+    start = time.perf_counter()
+    fn()
+    seconds = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    result = {'name':name,'seconds':seconds,'items':items,'throughput':items/seconds if seconds > 0 else None,'peak_mb':peak/2**20}
+    print(f"{name:<22} {seconds:9.3f} s {result['throughput'] or 0:12.1f} items/s {result['peak_mb']:9.1f} MB")
+    return result
+
+#Writes the stack with every output profile and times the site reads of each copy, the results also have the size of the copy
+#the reads follow the writes so they come from the page cache and show the decoding cost, not the disk
+def profile_benchmarks(tifs,sites,workdir):
+    results = []
+    for profile in functions.OUTPUT_PROFILES:
+        folder = os.path.join(workdir,profile)
+        os.makedirs(folder,exist_ok=True)
+        outputs = [os.path.join(folder,os.path.basename(tif)) for tif in tifs]
+        write = lambda: [functions.write_output(outputs[x],functions.gdal.Open(tifs[x]),profile) for x in range(len(tifs))]
+        result = measure('write_'+profile,write,len(tifs))
+        result['output_mb'] = sum(os.path.getsize(path) for path in outputs)/2**20
+        print(f"{'':<22} {result['output_mb']:9.1f} MB on disk")
+        results.append(result)
+        results.append(measure('read_'+profile,lambda: [functions.get_zonal_stats(outputs,site) for site in sites.geometry],len(tifs)*len(sites)))
+    return results
+
+#Runs every benchmark on data of one size in a temporary folder, returns the list of results
+def run_benchmarks(size,workdir):
+    config = SIZES[size]
+    stackDir = os.path.join(workdir,'stack')
+    tifs = make_stack(stackDir,config['dates'],config['width'],config['height'])
+    sites = make_sites(config['sites'],config['width'],config['height'])
+    scenes = make_scenes(config['scenes'])
+    conn = sqlite3.connect(os.path.join(workdir,'bench.db'))
+    conn.execute("CREATE TABLE bench (primary_scene text, secondary_scene text, site text, insar_name text, primary_date date, secondary_date date, vertdisp_path text, coherence_path text, reference_date date)")
+    conn.commit()
+    points = [(ORIGIN[0]+x*PIXEL*config['width']/50,ORIGIN[1]-x*PIXEL*config['height']/50) for x in range(1,50)]
+    results = []
+    results.append(measure('get_bounds',lambda: functions.get_bounds(tifs),len(tifs)))
+    cropped = []
+    results.append(measure('crop_Tifs',lambda: cropped.extend(functions.crop_Tifs(tifs)),len(tifs)))
+    results.append(measure('reproject',lambda: functions.reproject('EPSG:4326',cropped,conn,'bench'),len(cropped)))
+    results.append(measure('warp_tifs',lambda: functions.warp_tifs(tifs,CRS,conn,'bench',workers=1),len(tifs)))
+    site = sites.geometry.iloc[0]
+    results.append(measure('get_zonal_stats',lambda: functions.get_zonal_stats(tifs,site),len(tifs)))
+    results.append(measure('get_zonal_stats_1mb',lambda: functions.get_zonal_stats(tifs,site,memoryBudget=2**20),len(tifs)))
+    shpPath = os.path.join(workdir,'sites.shp')
+    sites.to_file(shpPath)
+    conn.executemany("INSERT INTO bench (site, vertdisp_path, reference_date) VALUES (?, ?, ?)",[(name,tifs[x],f"2017-{x//28+1:02d}-{x%28+1:02d}") for x in range(len(tifs)) for name in sites['Name']])
+    conn.commit()
+    results.append(measure('all_sites_stats',lambda: functions.all_sites_stats('bench',conn,shpPath),len(tifs)*len(sites)))
+    results.append(measure('sample_points',lambda: functions.sample_points(tifs,points,'bilinear'),len(tifs)*len(points)))
+    results.extend(profile_benchmarks(tifs,sites,workdir))
+    results.append(measure('create_jobs',lambda: functions.create_jobs('SITE0',scenes,conn,'bench'),len(scenes)))
+    conn.close()
+    return results
+
+#git commit of the tree being benchmarked
+def git_commit():
+    try:
+        return subprocess.run(['git','rev-parse','--short','HEAD'],capture_output=True,text=True,cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        return None
+
+#Adds a run to the json history and prints how each benchmark changed since the last run of the same size
+#threshold:float (slowdown ratio reported as a regression)
+def record(history,size,results,threshold=1.2):
+    runs = []
+    if os.path.exists(history):
+        with open(history) as f:
+            runs = json.load(f)
+    previous = next((run for run in reversed(runs) if run['size'] == size),None)
+    regressions = []
+    if previous is not None:
+        before = {result['name']: result for result in previous['results']}
+        for result in results:
+            if result['name'] in before and before[result['name']]['seconds'] > 0:
+                ratio = result['seconds'] / before[result['name']]['seconds']
+                flag = '  REGRESSION' if ratio > threshold else ''
+                print(f"{result['name']:<22} {ratio:6.2f}x the time of {previous['commit']}{flag}")
+                if flag:
+                    regressions.append(result['name'])
+    runs.append({'time':datetime.now().isoformat(timespec='seconds'),'commit':git_commit(),'size':size,'results':results})
+    with open(history,'w') as f:
+        json.dump(runs,f,indent=1)
+    return regressions
+
+if __name__ == '__main__':
+    main = argparse.ArgumentParser(description="Benchmark the raster and planning hot paths on synthetic data")
+    main.add_argument('--size',choices=list(SIZES),default='small')
+    main.add_argument('--history',default='benchmark_history.json')
+    main.add_argument('--threshold',type=float,default=1.2,help="slowdown ratio reported as a regression")
+    args = main.parse_args()
+    with tempfile.TemporaryDirectory() as workdir:
+        results = run_benchmarks(args.size,workdir)
+    regressions = record(args.history,args.size,results,args.threshold)
+    if regressions:
+        raise SystemExit("Regressions: "+', '.join(regressions))
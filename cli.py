@@ -0,0 +1,213 @@
+#Command line entry point for the enrichment pipeline
+#Each subcommand only imports what it needs: functions.py loads gdal, rasterio, geopandas, matplotlib, asf_search and
+#hyp3_sdk the first time they are used, so db queries and short cron tasks start in a fraction of a second
+#usage: python cli.py <search|submit|download|process|stats|sbas|report|startup> -h
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+
+import database
+
+#keys of functions.OUTPUT_PROFILES, listed here so the cli does not import functions to build its help
+PROFILES = ('gtiff','tiled','cog','cog-zstd')
+
+
+#reads the ASF username and password from a login json file like geodata/Login.json
+def read_login(path):
+    with open(path) as jsonFile:
+        login = json.load(jsonFile)
+    if login['UserName'] == "" or login['Password'] == "":
+        sys.exit("Please input Username and Password in "+path)
+    return login['UserName'], login['Password']
+
+#opens the project db and creates the project table if it does not exist
+def open_project(dbPath,tName):
+    conn = database.connect(dbPath)
+    database.create_project_table(conn,tName)
+    database.create_indexes(conn,tName)
+    return conn
+
+#searches ASF for every site, registers the pairs in the db and saves the jobs to send
+def search(args):
+    import functions
+    conn = open_project(args.db,args.table)
+    jobs = functions.insar_jobs(args.shp,conn,args.table,cacheDir=args.cache_dir,ttl=args.ttl,workers=args.workers,
+                                neighbours=args.neighbours,maxTemporal=args.max_temporal,catalogPath=args.catalog)
+    with open(args.jobs,'w') as output:
+        json.dump(jobs,output)
+    print("Jobs saved to "+args.jobs)
+
+#sends the saved jobs to ASF and downloads them, with --stream each product is processed as soon as its job is done
+def submit(args):
+    import functions
+    userName, password = read_login(args.login)
+    with open(args.jobs) as jobsFile:
+        jobs = json.load(jobsFile)
+    os.makedirs(args.out,exist_ok=True)
+    if args.stream:
+        conn = open_project(args.db,args.table)
+        functions.stream_jobs(userName,password,jobs,args.out,args.table,conn,args.shp,workers=args.workers,pollInterval=args.poll,apiUrl=args.api_url,profile=args.profile,bounds=args.bounds)
+    else:
+        functions.send_jobs(userName,password,jobs,args.out)
+
+#downloads every job of the project that was already sent
+def download(args):
+    from hyp3_sdk import HyP3
+    userName, password = read_login(args.login)
+    hyp3 = HyP3(username = userName, password = password)
+    jobName = hyp3.find_jobs(name = args.table)
+    os.makedirs(args.out,exist_ok=True)
+    jobName.download_files(location = args.out)
+
+#unzips, crops and reprojects the downloaded products
+def process(args):
+    import functions
+    conn = open_project(args.db,args.table)
+    functions.process_tifs(args.raw,args.table,args.shp,conn,cubePath=args.cube,workers=args.workers,virtual=args.virtual,profile=args.profile,mintpyDir=args.mintpy)
+
+#computes the stats of every site and saves them as a csv
+def stats(args):
+    import functions
+    conn = open_project(args.db,args.table)
+    budget = args.memory_budget*2**20 if args.memory_budget else None
+    table = functions.all_sites_stats(args.table,conn,args.shp,args.cube,budget,args.coherence,args.weighted)
+    table.to_csv(args.out,index=False)
+    print(str(len(table))+" rows saved to "+args.out)
+
+#inverts the pair network for the displacement history of a site (csv) or of every pixel of the cube (h5)
+def sbas(args):
+    import functions
+    conn = open_project(args.db,args.table)
+    if args.site is not None and args.cube is None:
+        history = functions.sbas_site(args.table,conn,args.shp,args.site,args.statistic)
+        history.to_csv(args.out,index=False)
+        print(str(len(history))+" dates saved to "+args.out)
+        return
+    if args.cube is None:
+        sys.exit("sbas needs --site or --cube")
+    site = None
+    if args.site is not None:
+        proj = functions.gpd.read_file(args.shp)
+        site = proj['geometry'][list(proj['Name']).index(args.site)]
+    functions.sbas_pixels(args.table,conn,args.cube,args.out,site,args.memory_budget*2**20)
+
+#renders the report pages of every site
+def report(args):
+    import functions
+    conn = open_project(args.db,args.table)
+    functions.render_reports(args.table,conn,args.shp,args.out,workers=args.workers,formats=args.formats,cube=args.cube)
+
+#times the start up of the cli and of importing functions.py and lists the heavy packages loaded by the import
+def startup(args):
+    here = os.path.dirname(os.path.abspath(__file__))
+    commands = {'cli --help':[sys.executable,os.path.join(here,'cli.py'),'--help'],
+                'import functions':[sys.executable,'-c','import functions'],
+                'python':[sys.executable,'-c','pass']}
+    for name, command in commands.items():
+        times = []
+        for x in range(args.repeat):
+            start = time.perf_counter()
+            subprocess.run(command,cwd=here,stdout=subprocess.DEVNULL,check=True)
+            times.append(time.perf_counter() - start)
+        print(f"{name:<18} best {min(times)*1000:7.1f} ms   mean {sum(times)/len(times)*1000:7.1f} ms")
+    heavy = ['osgeo','rasterio','geopandas','pandas','numpy','matplotlib','asf_search','hyp3_sdk','h5py','shapely','mintpy']
+    check = "import sys, functions; print(' '.join(m for m in %r if m in sys.modules))" % heavy
+    loaded = subprocess.run([sys.executable,'-c',check],cwd=here,capture_output=True,text=True,check=True).stdout.strip()
+    print("heavy packages loaded by import functions: "+(loaded or "none"))
+
+def parser():
+    main = argparse.ArgumentParser(description="InSAR monitoring of coastal enrichment sites")
+    main.add_argument('--metrics',default=None,help="write stage metrics to this .json or .prom file")
+    commands = main.add_subparsers(dest='command',required=True)
+
+    def project(command):
+        command.add_argument('--db',default='enrichment.db',help="project database")
+        command.add_argument('--table',required=True,help="project table name")
+
+    command = commands.add_parser('search',help="search ASF and plan the InSAR jobs")
+    project(command)
+    command.add_argument('--shp',required=True,help="shapefile of the sites")
+    command.add_argument('--jobs',default='jobs.json',help="file the prepared jobs are saved to")
+    command.add_argument('--cache-dir',default='asf_cache')
+    command.add_argument('--ttl',type=int,default=86400,help="seconds a cached search is kept")
+    command.add_argument('--catalog',default='scene_catalog',help="Parquet scene catalog")
+    command.add_argument('--workers',type=int,default=8)
+    command.add_argument('--neighbours',type=int,default=3)
+    command.add_argument('--max-temporal',type=int,default=None,help="max days between paired scenes")
+    command.set_defaults(run=search)
+
+    command = commands.add_parser('submit',help="send the jobs to ASF and download them")
+    project(command)
+    command.add_argument('--login',default='geodata/Login.json')
+    command.add_argument('--jobs',default='jobs.json')
+    command.add_argument('--out',required=True,help="folder for the downloads")
+    command.add_argument('--stream',action='store_true',help="process each product as soon as its job is done")
+    command.add_argument('--shp',help="shapefile of the sites (needed with --stream)")
+    command.add_argument('--workers',type=int,default=4)
+    command.add_argument('--poll',type=int,default=60,help="seconds between job status checks")
+    command.add_argument('--api-url',default=None,help="HyP3 api to use instead of ASF")
+    command.add_argument('--profile',choices=PROFILES,default='gtiff',help="layout of the processed tifs (with --stream)")
+    command.add_argument('--bounds',type=float,nargs=4,default=None,metavar=('LEFT','BOTTOM','RIGHT','TOP'),
+                         help="crop bounds in the crs of the products (with --stream), without them and a project grid the products are cropped once every job is done")
+    command.set_defaults(run=submit)
+
+    command = commands.add_parser('download',help="download the jobs already sent for the project")
+    project(command)
+    command.add_argument('--login',default='geodata/Login.json')
+    command.add_argument('--out',required=True)
+    command.set_defaults(run=download)
+
+    command = commands.add_parser('process',help="unzip, crop and reproject the downloaded products")
+    project(command)
+    command.add_argument('--raw',required=True,help="folder of the downloads")
+    command.add_argument('--shp',required=True)
+    command.add_argument('--cube',default=None,help="also build a displacement cube at this path")
+    command.add_argument('--workers',type=int,default=None)
+    command.add_argument('--virtual',action='store_true',help="read the tifs inside the zips")
+    command.add_argument('--profile',choices=PROFILES,default='gtiff',help="layout of the processed tifs, cog writes compressed tiles with overviews")
+    command.add_argument('--mintpy',default=None,help="also write the MintPy input stacks to this MintPy folder")
+    command.set_defaults(run=process)
+
+    command = commands.add_parser('stats',help="zonal stats of every site")
+    project(command)
+    command.add_argument('--shp',required=True)
+    command.add_argument('--out',default='site_stats.csv')
+    command.add_argument('--cube',default=None)
+    command.add_argument('--memory-budget',type=int,default=None,help="MB per site, large sites are read in blocks")
+    command.add_argument('--coherence',type=float,default=None,help="also report stats of the pixels with at least this coherence")
+    command.add_argument('--weighted',action='store_true',help="add the coherence weighted mean (with --coherence)")
+    command.set_defaults(run=stats)
+
+    command = commands.add_parser('sbas',help="displacement history from the SBAS inversion of the pairs")
+    project(command)
+    command.add_argument('--shp',help="shapefile of the sites (needed with --site)")
+    command.add_argument('--site',default=None,help="site to invert, without --cube its mean of every pair is inverted")
+    command.add_argument('--cube',default=None,help="invert every pixel of the cube (or of the window around --site)")
+    command.add_argument('--statistic',default='mean',choices=['mean','median'])
+    command.add_argument('--out',required=True,help=".csv for a site, .h5 for the pixels")
+    command.add_argument('--memory-budget',type=int,default=256,help="MB of pair displacements read at once")
+    command.set_defaults(run=sbas)
+
+    command = commands.add_parser('report',help="render the report pages of every site")
+    project(command)
+    command.add_argument('--shp',required=True)
+    command.add_argument('--out',default='report')
+    command.add_argument('--workers',type=int,default=None)
+    command.add_argument('--formats',nargs='+',default=['png'])
+    command.add_argument('--cube',default=None)
+    command.set_defaults(run=report)
+
+    command = commands.add_parser('startup',help="benchmark the start up time")
+    command.add_argument('--repeat',type=int,default=5)
+    command.set_defaults(run=startup)
+    return main
+
+if __name__ == '__main__':
+    args = parser().parse_args()
+    if args.metrics:
+        import instrument
+        instrument.enable(args.metrics)
+    args.run(args)
@@ -0,0 +1,239 @@
+#Persistence layer for the project database
+#The db runs in WAL mode so readers never wait on the writer, all writes go through one writer thread that batches them
+#into transactions and reads use a pool of read-only connections. The functions in functions.py take either a plain
+#sqlite3 connection or a ProjectDB as conn, read, write_many and transaction pick the right path.
+import os
+import queue
+import sqlite3
+import threading
+from concurrent.futures import Future
+from contextlib import contextmanager
+
+import instrument
+
+
+#opens a connection to the project db, write connections turn on WAL mode unless wal is False
+#WAL needs shared memory so a db used by processes on several hosts (the queue workers) keeps the rollback journal
+#path:str (path to the .db file), readOnly:bool, timeout:float (seconds to wait for a lock), wal:bool
+def connect(path,readOnly=False,timeout=30,wal=True):
+    if readOnly:
+        conn = sqlite3.connect(f"file:{os.path.abspath(path)}?mode=ro",uri=True,timeout=timeout,check_same_thread=False)
+    elif wal:
+        conn = sqlite3.connect(path,timeout=timeout,check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL") #safe in WAL mode and much faster commits
+    else:
+        conn = sqlite3.connect(path,timeout=timeout,check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=DELETE")
+    conn.execute(f"PRAGMA busy_timeout = {int(timeout*1000)}")
+    return conn
+
+#Creates the project table if it does not exist, tables made before reference_date was written get the column
+#and the date of their registered pairs (the primary date, like register_pairs writes it)
+#conn: write connection to db, tname:str (project table name)
+def create_project_table(conn,tName):
+    conn.execute(f"CREATE TABLE IF NOT EXISTS {tName} (primary_scene text, secondary_scene text, site text, insar_name text, primary_date date, secondary_date date, vertdisp_path text, coherence_path text, reference_date date)")
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({tName})")]
+    if 'reference_date' not in columns:
+        conn.execute(f"ALTER TABLE {tName} ADD COLUMN reference_date date")
+    conn.execute(f"UPDATE {tName} SET reference_date = primary_date WHERE reference_date IS NULL AND primary_date IS NOT NULL")
+    conn.commit()
+
+#Creates the indexes on the project table used by the pipeline and analysis queries
+#conn: write connection to db, tname:str (project table name)
+def create_indexes(conn,tName):
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({tName})")]
+    for column in ('site','insar_name','primary_date','secondary_date','reference_date','vertdisp_path'):
+        if column in columns:
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {tName}_{column}_idx ON {tName} ({column})")
+    conn.execute(f"CREATE INDEX IF NOT EXISTS {tName}_pair_idx ON {tName} (primary_scene, secondary_scene, site)")
+    conn.commit()
+
+#Thread that owns the only write connection, queued writes are committed together in batches
+#path:str (path to the .db file), batchSize:int (max writes in one transaction)
+class Writer:
+    def __init__(self,path,batchSize=500):
+        self.path = path
+        self.batchSize = batchSize
+        self.queue = queue.Queue()
+        self.errors = {} #write errors of each thread that queued writes, raised by its next flush
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.run,name='db-writer',daemon=True)
+        self.thread.start()
+
+    #queues one statement
+    def execute(self,sql,params=()):
+        self.queue.put((sql,params,False,threading.get_ident()))
+
+    #queues one statement run for every row
+    def executemany(self,sql,rows):
+        self.queue.put((sql,list(rows),True,threading.get_ident()))
+
+    #runs fn(conn) on the writer thread in its own transaction and returns a Future of its result
+    def submit(self,fn):
+        future = Future()
+        self.queue.put((fn,future,None))
+        return future
+
+    #waits until every queued write is committed and raises the first error of the writes this thread queued since its last flush
+    def flush(self):
+        self.submit(lambda conn: None).result()
+        with self.lock:
+            errors = self.errors.pop(threading.get_ident(),None)
+        if errors:
+            raise errors[0]
+
+    def close(self):
+        self.flush()
+        self.queue.put(None)
+        self.thread.join()
+
+    def run(self):
+        conn = connect(self.path)
+        pending = []
+        while True:
+            item = pending.pop() if pending else self.queue.get()
+            if item is None:
+                break
+            if item[2] is None: #a function gets its own transaction
+                fn, future = item[0], item[1]
+                try:
+                    result = fn(conn)
+                    conn.commit()
+                    future.set_result(result)
+                except Exception as e:
+                    conn.rollback()
+                    future.set_exception(e)
+                continue
+            #take every write already waiting (up to batchSize) into the same transaction
+            batch = [item]
+            while len(batch) < self.batchSize:
+                try:
+                    item = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if item is None or item[2] is None:
+                    pending.append(item) #handled after this batch
+                    break
+                batch.append(item)
+            #every write has its own savepoint so a failing write is undone alone and the rest of the batch is committed
+            if not conn.in_transaction:
+                conn.execute("BEGIN")
+            for sql, params, many, owner in batch:
+                conn.execute("SAVEPOINT write")
+                try:
+                    if many:
+                        conn.executemany(sql,params)
+                    else:
+                        conn.execute(sql,params)
+                except Exception as e:
+                    conn.execute("ROLLBACK TO write")
+                    with self.lock:
+                        self.errors.setdefault(owner,[]).append(e)
+                conn.execute("RELEASE write")
+            try:
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                with self.lock:
+                    for owner in dict.fromkeys(item[3] for item in batch):
+                        self.errors.setdefault(owner,[]).append(e)
+        conn.close()
+
+#Pool of read-only connections shared by threads
+#path:str (path to the .db file), size:int (number of connections)
+class ReadPool:
+    def __init__(self,path,size=4):
+        self.connections = queue.Queue()
+        for x in range(size):
+            self.connections.put(connect(path,readOnly=True))
+
+    @contextmanager
+    def connection(self):
+        conn = self.connections.get()
+        try:
+            yield conn
+        finally:
+            self.connections.put(conn)
+
+    def query(self,sql,params=()):
+        with self.connection() as conn:
+            return conn.execute(sql,params).fetchall()
+
+    def close(self):
+        while not self.connections.empty():
+            self.connections.get().close()
+
+#Project database shared by pool workers and analysis notebooks
+#path:str (path to the .db file), tname:str (optional project table to index), readers:int (read connections), batchSize:int (max writes in one transaction)
+class ProjectDB:
+    def __init__(self,path,tName=None,readers=4,batchSize=500):
+        self.path = path
+        conn = connect(path) #turns on WAL mode before the read-only connections open
+        if tName is not None:
+            create_indexes(conn,tName)
+        conn.close()
+        self.writer = Writer(path,batchSize)
+        self.readers = ReadPool(path,readers)
+
+    def query(self,sql,params=()):
+        return self.readers.query(sql,params)
+
+    def execute(self,sql,params=()):
+        self.writer.execute(sql,params)
+
+    def executemany(self,sql,rows):
+        self.writer.executemany(sql,rows)
+
+    def flush(self):
+        self.writer.flush()
+
+    def close(self):
+        self.writer.close()
+        self.readers.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*args):
+        self.close()
+
+#runs a query on a sqlite3 connection or ProjectDB and returns all the rows
+def read(conn,sql,params=()):
+    if isinstance(conn,ProjectDB):
+        return conn.query(sql,params)
+    cursor = conn.cursor()
+    try:
+        cursor.execute(sql,params)
+        return cursor.fetchall()
+    finally:
+        cursor.close()
+
+#runs a statement for every row, a ProjectDB queues it for the writer thread and a sqlite3 connection commits it
+def write_many(conn,sql,rows):
+    rows = list(rows)
+    instrument.count('rows_written',len(rows))
+    if isinstance(conn,ProjectDB):
+        conn.executemany(sql,rows)
+        return
+    transaction(conn,lambda c: c.executemany(sql,rows))
+
+#waits for the queued writes of a ProjectDB to be committed (sqlite3 connections commit right away)
+def flush(conn):
+    if isinstance(conn,ProjectDB):
+        conn.flush()
+
+#runs fn(conn) in one transaction that is rolled back if fn raises, on a ProjectDB it runs on the writer thread
+#a sqlite3 connection takes the write lock at the start so reads and writes of fn are atomic across processes (like the queue workers)
+def transaction(conn,fn):
+    if isinstance(conn,ProjectDB):
+        return conn.writer.submit(fn).result()
+    if not conn.in_transaction:
+        conn.execute("BEGIN IMMEDIATE")
+    try:
+        result = fn(conn)
+        conn.commit()
+        return result
+    except Exception:
+        conn.rollback()
+        raise
@@ -1,132 +1,336 @@
 #import packages used
 import os 
+import hashlib
+import importlib
+import json
 from datetime import datetime
 from datetime import timedelta
 import statistics as stats
-import asf_search as asf
-import pandas as pd
-from hyp3_sdk import HyP3 
-import geopandas as gpd
 from zipfile import ZipFile 
-from osgeo import gdal,ogr
-import rasterio as rio
-import rioxarray as rxr
-import rasterstats as rs
-import matplotlib.pyplot as plt
-import matplotlib.dates as mdates
-import numpy as np
-from dateutil.relativedelta import relativedelta
 import subprocess
-import matplotlib.patches as mpatches
-import matplotlib.ticker as ticker
-
-
-#Extracts scenes from ASF job search and creates list of all scene names, dates, frames, and paths. Exports the list as a csv
-#data:geojson
-def get_scene_name(data,name): 
-    count = len(data["features"])                   
-    scenes = []
-    dates = []
-    frames=[]
-    paths=[]
-    urls = []
-    for x in range(count):
-        scene = data["features"][x]["properties"]["sceneName"]
-        date = data["features"][x]["properties"]["startTime"]
-        frame = data["features"][x]["properties"]["frameNumber"]
-        path = data["features"][x]["properties"]["pathNumber"]
-        url = data["features"][x]["properties"]["url"]
-        scenes.append(scene)
-        dates.append(date)
-        frames.append(frame)
-        paths.append(path)
-        urls.append(url)
-    df = pd.DataFrame(list(zip(dates, scenes, frames, paths, urls)),columns =['Dates', 'SceneNames','Frames', 'Paths','Urls'])
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import warnings
+import database
+import instrument
+
+
+#Imports a module the first time one of its attributes is used so scripts that only need the db or job planning start fast
+#name:str (module to import), submodules:tuple (submodules used as attributes, like rasterio.features)
+class LazyModule:
+    def __init__(self,name,submodules=()):
+        self.name = name
+        self.submodules = submodules
+        self.module = None
+
+    def load(self):
+        if self.module is None:
+            for submodule in self.submodules:
+                importlib.import_module(submodule)
+            self.module = importlib.import_module(self.name)
+        return self.module
+
+    def __getattr__(self,attr):
+        if attr in ('name','submodules','module'): #not set yet (copy or pickle)
+            raise AttributeError(attr)
+        return getattr(self.load(),attr)
+
+#A class or function of a module that is only imported the first time it is called or used
+#module: LazyModule, name:str (name of the object in the module)
+class LazyObject:
+    def __init__(self,module,name):
+        self.module = module
+        self.name = name
+
+    def __getattr__(self,attr):
+        if attr in ('module','name'):
+            raise AttributeError(attr)
+        return getattr(getattr(self.module.load(),self.name),attr)
+
+    def __call__(self,*args,**kwargs):
+        return getattr(self.module.load(),self.name)(*args,**kwargs)
+
+#heavy packages, imported the first time they are used
+asf = LazyModule('asf_search')
+pd = LazyModule('pandas')
+HyP3 = LazyObject(LazyModule('hyp3_sdk'),'HyP3')
+gpd = LazyModule('geopandas')
+box = LazyObject(LazyModule('shapely.geometry'),'box')
+shape = LazyObject(LazyModule('shapely.geometry'),'shape')
+unary_union = LazyObject(LazyModule('shapely.ops'),'unary_union')
+gdal = LazyModule('osgeo.gdal')
+ogr = LazyModule('osgeo.ogr')
+rio = LazyModule('rasterio',('rasterio.features','rasterio.windows'))
+plt = LazyModule('matplotlib.pyplot')
+mdates = LazyModule('matplotlib.dates')
+np = LazyModule('numpy')
+h5py = LazyModule('h5py')
+mpatches = LazyModule('matplotlib.patches')
+ticker = LazyModule('matplotlib.ticker')
+relativedelta = LazyObject(LazyModule('dateutil.relativedelta'),'relativedelta')
+
+
+#Extracts scenes from ASF job search and creates list of all scene names, dates, frames, paths, urls and footprints
+#The scenes are added to the Parquet scene catalog at catalogPath, or exported as name.csv when there is no catalog
+#data:geojson, name:str (site name for the csv), catalogPath:str (folder of the scene catalog)
+def get_scene_name(data,name=None,catalogPath=None): 
+    properties = pd.DataFrame([feature["properties"] for feature in data["features"]])
+    if properties.empty:
+        properties = pd.DataFrame(columns=['startTime','sceneName','frameNumber','pathNumber','url'])
+    df = pd.DataFrame({'Dates':scene_dates(properties['startTime'].astype(str)),
+                       'SceneNames':properties['sceneName'],
+                       'Frames':properties['frameNumber'].astype(int),
+                       'Paths':properties['pathNumber'].astype(int),
+                       'Urls':properties['url'],
+                       'PerpBaseline':pd.to_numeric(properties['perpendicularBaseline'],errors='coerce') if 'perpendicularBaseline' in properties else np.nan, #only in baseline searches
+                       'Footprint':[shape(feature["geometry"]).wkt for feature in data["features"]]})
     #Sort by Path then frame then date
-    df.sort_values(by=['Paths','Frames','Dates'],ignore_index=True,inplace=True)
-    dfDropDup=df.drop_duplicates()
-    dfDropDup.to_csv(name+'.csv')
+    dfDropDup = df.drop_duplicates(subset='SceneNames').sort_values(by=['Paths','Frames','Dates'],ignore_index=True)
+    if catalogPath is not None:
+        update_scene_catalog(dfDropDup,catalogPath)
+    elif name is not None:
+        dfDropDup.to_csv(name+'.csv')
     return dfDropDup
 
+#Reads the scene catalog, filters are pushed down to the Parquet files, returns an empty dataframe if there is no catalog
+def read_scene_catalog(catalogPath,filters=None):
+    if not os.path.exists(catalogPath):
+        return pd.DataFrame(columns=['Dates','SceneNames','Frames','Paths','Urls','PerpBaseline','Footprint'])
+    catalog = pd.read_parquet(catalogPath,filters=filters)
+    #partition columns are read back as categories
+    catalog['Paths'] = catalog['Paths'].astype(int)
+    catalog['Frames'] = catalog['Frames'].astype(int)
+    return catalog
+
+#Adds scenes to the Parquet scene catalog partitioned by path and frame, scenes already in the catalog are replaced
+#scenes: dataframe from get_scene_name, catalogPath:str (folder of the scene catalog)
+def update_scene_catalog(scenes,catalogPath):
+    if scenes.empty:
+        return
+    #only the partitions of the new scenes are read and rewritten
+    existing = read_scene_catalog(catalogPath,[('Paths','in',list(scenes['Paths'].unique()))])
+    existing = existing[existing['Frames'].isin(scenes['Frames'].unique())]
+    catalog = pd.concat([existing,scenes],ignore_index=True).drop_duplicates(subset='SceneNames',keep='last')
+    catalog = catalog.sort_values(by=['Paths','Frames','Dates'],ignore_index=True)
+    catalog.to_parquet(catalogPath,partition_cols=['Paths','Frames'],index=False,existing_data_behavior='delete_matching')
+
+#Gets the scenes in the catalog that intersect a geometry in a date range
+#catalogPath:str (folder of the scene catalog), geometry: shapely geometry in lon/lat, start and end: dates, paths and frames: lists of path and frame numbers
+def query_scenes(catalogPath,geometry=None,start=None,end=None,paths=None,frames=None):
+    filters = []
+    if start is not None:
+        filters.append(('Dates','>=',pd.Timestamp(start)))
+    if end is not None:
+        filters.append(('Dates','<=',pd.Timestamp(end)))
+    if paths is not None:
+        filters.append(('Paths','in',list(paths)))
+    if frames is not None:
+        filters.append(('Frames','in',list(frames)))
+    scenes = read_scene_catalog(catalogPath,filters or None)
+    if geometry is not None and not scenes.empty:
+        scenes = scenes[gpd.GeoSeries.from_wkt(scenes['Footprint']).intersects(geometry).values]
+    return scenes.sort_values(by=['Paths','Frames','Dates'],ignore_index=True)
+
+#Creates the indexes used to look up pairs, sites, InSARs and dates in the project table, tables made in the notebooks
+#without reference_date get the column first
+#conn: connection to db, tname:str (project table name)
+def create_pair_indexes(conn,tName):
+    def create(c):
+        database.create_project_table(c,tName)
+        database.create_indexes(c,tName)
+    database.transaction(conn,create)
+
+#Inputs the scene pairs of the sites into the database in one transaction and returns the pairs that are new to the project
+#Pairs already in the db for another site only get a new row for the site, pairs already in the db for the same site are skipped
+#pairs:list ((site, primary scene, secondary scene, primary date, secondary date)), conn: connection to db, tname:str (project table name)
+@instrument.instrumented('register_pairs')
+def register_pairs(pairs,conn,tName):
+    create_pair_indexes(conn,tName)
+    def register(conn):
+        cursor = conn.cursor()
+        #find every candidate pair already in the db with one indexed join
+        cursor.execute("CREATE TEMP TABLE IF NOT EXISTS candidate_pairs (primary_scene text, secondary_scene text)")
+        cursor.execute("DELETE FROM candidate_pairs")
+        cursor.executemany("INSERT INTO candidate_pairs VALUES (?, ?)",list(dict.fromkeys((pair[1],pair[2]) for pair in pairs)))
+        cursor.execute(f"SELECT t.primary_scene, t.secondary_scene, t.site, t.primary_date, t.secondary_date FROM candidate_pairs c JOIN {tName} t ON t.primary_scene = c.primary_scene AND t.secondary_scene = c.secondary_scene")
+        existing = {}
+        linked = set()
+        for row in cursor.fetchall():
+            existing[(row[0],row[1])] = (row[3],row[4])
+            linked.add((row[0],row[1],row[2]))
+
+        rows = []
+        newPairs = []
+        for site, scene1, scene2, date1, date2 in pairs:
+            if (scene1,scene2,site) in linked:
+                continue
+            if (scene1,scene2) in existing: #if pair is in db then add new row with same data, but with the new site
+                date1, date2 = existing[(scene1,scene2)]
+            else: #if pair is not in db it needs a job
+                existing[(scene1,scene2)] = (date1,date2)
+                newPairs.append((scene1,scene2))
+            linked.add((scene1,scene2,site))
+            rows.append((scene1,scene2,date1,date2,date1,site))
+        #the reference date of a pair is its primary date, the stats and plots order the products by it
+        cursor.executemany(f"INSERT INTO {tName} (primary_scene, secondary_scene, primary_date, secondary_date, reference_date, site) VALUES (?, ?, ?, ?, ?, ?)",rows)
+        cursor.execute("DELETE FROM candidate_pairs")
+        cursor.close()
+        print(str(len(rows))+" rows added to "+tName)
+        return newPairs, len(rows)
+    #a ProjectDB runs register on its writer thread so the rows are counted here
+    newPairs, added = database.transaction(conn,register)
+    instrument.count('rows_written',added)
+    return newPairs
+
+#Parses the scene dates, dates already read as datetimes are kept
+def scene_dates(dates):
+    if pd.api.types.is_datetime64_any_dtype(dates):
+        return dates
+    return pd.to_datetime(dates.str.rstrip('Z'))
+
+#Builds the small baseline network of a scene list, each scene is paired with the next scenes of the same path and frame
+#neighbours:int (number of later scenes each scene is paired with), maxTemporal:int (max days between the scenes, None for no limit)
+#maxPerpendicular:float (max perpendicular baseline in meters, None for no limit, needs the PerpBaseline column)
+#data: dataframe from get_scene_name, returns a dataframe of primary_scene, secondary_scene, primary_date, secondary_date
+def build_network(data,neighbours=3,maxTemporal=None,maxPerpendicular=None):
+    if maxPerpendicular is not None and ('PerpBaseline' not in data or data['PerpBaseline'].isna().all()):
+        raise ValueError("maxPerpendicular needs a PerpBaseline column in the scene list")
+    columns = ['SceneNames','Time'] + (['PerpBaseline'] if maxPerpendicular is not None else [])
+    data = data.drop_duplicates(subset='SceneNames').assign(Time=lambda df: scene_dates(df['Dates']))
+    data = data.sort_values(by=['Paths','Frames','Time'],ignore_index=True) #Sort by Path then frame then date
+    groups = data.groupby(['Paths','Frames'],sort=False)[columns]
+    pairs = []
+    for j in range(1, neighbours+1):
+        #scene j places later in the same path and frame
+        later = groups.shift(-j)
+        keep = later['SceneNames'].notna()
+        if maxTemporal is not None:
+            keep &= (later['Time'] - data['Time']).dt.days <= maxTemporal
+        if maxPerpendicular is not None:
+            keep &= (later['PerpBaseline'] - data['PerpBaseline']).abs() <= maxPerpendicular
+        pairs.append(pd.DataFrame({'primary_scene':data['SceneNames'][keep],
+                                   'secondary_scene':later['SceneNames'][keep],
+                                   'primary_date':data['Time'][keep].dt.date,
+                                   'secondary_date':later['Time'][keep].dt.date}))
+    network = pd.concat(pairs,ignore_index=True)
+    return network.sort_values(by=['primary_date','secondary_date'],ignore_index=True)
+
+#prepares the HyP3 InSAR jobs of a list of pairs, pairs:list ((primary scene, secondary scene)), tname:str (project table name)
+def prepare_jobs(pairs,tName):
+    return [HyP3.prepare_insar_job(scene1, scene2, name = tName, include_displacement_maps=True,include_dem=True,include_look_vectors=True) for scene1, scene2 in pairs]
+
 #creates the list of all jobs to be sent to ASF servers and inputs the scene pairs for each site into the database   
-#site:str (site name in gpd), data:list (list of scenes), date:list (list of dates), conn: connection to db, tname:str (project table name)
-def create_jobs(site,data,conn,tName): 
-    listjobs=[]
-    count = len(data) 
-    
-    #for all the scenes in the scene list we will pair the scenes together to create InSARs
-    for i in range(count-1): 
-        
-        #We want to create triplets for all the SARs images so another loop is needed to create triplets:
-        for j in range(1, 4):
-            if i +j >= count:
+#site:str (site name in gpd), data:list (list of scenes), conn: connection to db, tname:str (project table name)
+#neighbours, maxTemporal and maxPerpendicular are passed to build_network
+def create_jobs(site,data,conn,tName,neighbours=3,maxTemporal=None,maxPerpendicular=None): 
+    network = build_network(data,neighbours,maxTemporal,maxPerpendicular)
+    pairs = [(site,*row) for row in network.itertuples(index=False)]
+    #Inputting the pairs into the SQLlite database, only the pairs new to the project are sent as jobs
+    newPairs = register_pairs(pairs,conn,tName)
+    return prepare_jobs(newPairs,tName)
+
+#parameters of the ASF search used for every site
+SEARCH_OPTIONS = {'platform':"Sentinel-1", 'beamMode':"IW", 'polarization':"VV+VH", 'processingLevel':"SLC"}
+
+#ASF search with the results cached on disk as geojson, a search with the same geometry and dates is only sent again after ttl seconds
+#geo:str (wkt in lon/lat), start:str, end:str, cacheDir:str (folder of the cache), ttl:int (seconds), searchFn: function with the parameters of asf.search (None uses asf.search)
+def cached_search(geo,start,end,cacheDir='asf_cache',ttl=86400,searchFn=None):
+    key = hashlib.sha1(json.dumps([geo,start,end,SEARCH_OPTIONS],sort_keys=True).encode()).hexdigest()
+    cacheFile = os.path.join(cacheDir,key+'.json')
+    if os.path.exists(cacheFile) and time.time() - os.path.getmtime(cacheFile) < ttl:
+        with open(cacheFile,'r') as f:
+            return json.load(f)
+    if searchFn is None:
+        searchFn = asf.search
+    searchJson = searchFn(intersectsWith = geo, start = start, end = end, **SEARCH_OPTIONS).geojson()
+    os.makedirs(cacheDir,exist_ok=True)
+    #write to a temporary file first so other searches never read half a file
+    with open(cacheFile+'.tmp','w') as f:
+        json.dump(searchJson,f)
+    os.replace(cacheFile+'.tmp',cacheFile)
+    return searchJson
+
+#Groups sites into as few searches as possible, sites are searched together when their date windows overlap
+#and their bounds are within mergeDistance of the group (in degrees), each search covers the convex hull and dates of its sites
+#sites:list (dicts with name, geometry (shapely in lon/lat), start and end)
+def plan_searches(sites,mergeDistance=0.1):
+    groups = []
+    for site in sorted(sites,key=lambda site: site['start']):
+        for group in groups:
+            if site['start'] <= group['end'] and group['start'] <= site['end'] and box(*group['bounds']).distance(box(*site['geometry'].bounds)) <= mergeDistance:
+                group['sites'].append(site)
+                group['start'] = min(group['start'],site['start'])
+                group['end'] = max(group['end'],site['end'])
+                group['bounds'] = unary_union([box(*group['bounds']),site['geometry']]).bounds
                 break
-            
-            #The path and the frame of the two InSARs need to be the same to sucessfully create an InSAR of the pair.
-            #This checks to make sure the paths and frames are the same:
-            if data['Paths'][i] != data['Paths'][i+j] or data['Frames'][i] != data['Frames'][i+j]:
-                continue
-            
-            #If path and frame are equal create the pair
-            scene1 = data['SceneNames'][i]
-            scene2 = data['SceneNames'][i+j]
-            if data['Dates'][i+1].endswith('Z'):
-                sceneDate = datetime.strptime(data['Dates'][i], '%Y-%m-%dT%H:%M:%S.%fZ').date(),datetime.strptime(data['Dates'][i+j], '%Y-%m-%dT%H:%M:%S.%fZ').date()
-            else:
-                sceneDate = datetime.strptime(data['Dates'][i], '%Y-%m-%dT%H:%M:%S.%f').date(),datetime.strptime(data['Dates'][i+j], '%Y-%m-%dT%H:%M:%S.%f').date()
-            insar_job = HyP3.prepare_insar_job(scene1, scene2, name = tName, include_displacement_maps=True,include_dem=True,include_look_vectors=True)
-
-            #Inputting the primary scene, secondary scene, aquisition dates for the two scenes, and the site name into the SQLlite database.
-            try:
-                cursor = conn.cursor()
-                cursor.execute(f"SELECT primary_scene, secondary_scene, primary_date, secondary_date FROM {tName} WHERE primary_scene = ? AND secondary_scene = ?", (scene1,scene2)) #checking if the pair already exist in the database
-                row = cursor.fetchall()
-                #if pair is in db then add new row with same data, but with the new site
-                if row != []: 
-                    cursor.execute(f"INSERT INTO {tName} (primary_scene, secondary_scene, primary_date, secondary_date, site) VALUES (?, ?, ?, ?, ?)", (row[0][0], row[0][1],row[0][2],row[0][3], site))
-                    conn.commit()
-                    cursor.close()
-                    #do not add to jobs list
-                    
-                #if pair is not in db insert all new dats into the database
-                else:
-                    cursor.execute(f"INSERT INTO {tName} (primary_scene, secondary_scene, site, primary_date, secondary_date) VALUES(?, ?, ?, ?, ?)", (scene1,scene2, site, sceneDate[0],sceneDate[1]))
-                    #add to jobs list
-                    listjobs.append(insar_job)
-                    conn.commit()
-                    cursor.close()
-            except Exception as e:
-                print(e)
-    return listjobs 
+        else:
+            groups.append({'sites':[site],'start':site['start'],'end':site['end'],'bounds':site['geometry'].bounds})
+    for group in groups:
+        group['geometry'] = unary_union([site['geometry'] for site in group['sites']]).convex_hull
+    return groups
 
-#shpFile:str (path to .shp file), conn: connection to db, tname:str (project table name)
-def insar_jobs(shpFile,conn,tName): 
+#Keeps the scenes of a search that cover the site and are in its date window
+#searchJson:geojson (ASF search results), site:dict (name, geometry, start and end)
+def site_scenes(searchJson,site):
+    features = []
+    for feature in searchJson["features"]:
+        date = pd.Timestamp(feature["properties"]["startTime"].rstrip('Z'))
+        if site['start'] <= date <= site['end'] and shape(feature["geometry"]).intersects(site['geometry']):
+            features.append(feature)
+    return {"type":"FeatureCollection","features":features}
+
+#Gets the search of every site in a shapefile: its name, geometry in lon/lat and the dates 1 year before and after enrichment
+#shpFile:str (path to .shp file)
+def shapefile_sites(shpFile):
     shp: gpd.GeoDataFrame = gpd.read_file(shpFile) #Open shapefile as a geopandas dataframe
-    jobs=[]
+    if shp.crs is not None:
+        shp = shp.to_crs(epsg=4326) #ASF searches with lon/lat
+    sites = []
     for site in range(len(shp)): #for each site in the shapefile
-        dateSTR = shp['Date'][site] #Get the date of enrichment for the site
-        siteName = str(shp['Name'][site]) #Get the name of the site
-        date = datetime.strptime(dateSTR, '%Y-%m-%d')
-        start = str(date - timedelta(weeks = 52)) #1 year pre-enrichment
-        end = str(date + timedelta(weeks = 52)) #1 year post enrichment
-        geo = str(shp['geometry'][0]) #get the geometry of the site
-        print(shp.crs)
-        print("-------")
-        print(geo)
-        print("-------")
-        
-        #Create an API search based on set parameters:
-        searchResults = asf.search(platform = "Sentinel-1", beamMode = "IW", polarization = "VV+VH", intersectsWith = geo, processingLevel= "SLC", start = start, end = end)
-        searchJson = searchResults.geojson()
-        scenesList= get_scene_name(searchJson,siteName) #call the get_scene_name function
-        #print(scenesList)
-        jobsList = create_jobs(siteName,scenesList,conn,tName) #call the create_jobs function
-        jobs.extend(jobsList)
-    print("You will send "+str(len(jobs))+" jobs to ASF.")
+        date = datetime.strptime(shp['Date'][site], '%Y-%m-%d') #Get the date of enrichment for the site
+        sites.append({'name':str(shp['Name'][site]),
+                      'geometry':shp['geometry'][site],
+                      'start':pd.Timestamp(date - timedelta(weeks = 52)), #1 year pre-enrichment
+                      'end':pd.Timestamp(date + timedelta(weeks = 52))}) #1 year post enrichment
+    return sites
+
+#Runs the ASF searches of all the sites in a shapefile in a pool of threads and returns the scenes of each site
+#Each site is searched with its own geometry 1 year before and after enrichment, neighbouring sites share searches
+#shpFile:str (path to .shp file), workers:int (number of searches at once), see cached_search and plan_searches for the rest
+@instrument.instrumented('search_sites')
+def search_sites(shpFile,cacheDir='asf_cache',ttl=86400,workers=8,mergeDistance=0.1,searchFn=None):
+    sites = shapefile_sites(shpFile)
+    groups = plan_searches(sites,mergeDistance)
+    print(str(len(sites))+" sites in "+str(len(groups))+" searches")
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        results = list(pool.map(lambda group: cached_search(group['geometry'].wkt,str(group['start']),str(group['end']),cacheDir,ttl,searchFn),groups))
+    scenes = {}
+    for group, searchJson in zip(groups,results):
+        for site in group['sites']:
+            scenes[site['name']] = site_scenes(searchJson,site)
+    return scenes
+
+#shpFile:str (path to .shp file), conn: connection to db, tname:str (project table name)
+#cacheDir, ttl, workers, mergeDistance and searchFn are passed to search_sites, neighbours, maxTemporal and maxPerpendicular to build_network
+#catalogPath:str (folder of the Parquet scene catalog the scenes of every site are added to)
+@instrument.instrumented('insar_jobs')
+def insar_jobs(shpFile,conn,tName,cacheDir='asf_cache',ttl=86400,workers=8,mergeDistance=0.1,searchFn=None,neighbours=3,maxTemporal=None,maxPerpendicular=None,catalogPath='scene_catalog'): 
+    #Search for the scenes of every site:
+    siteScenes = search_sites(shpFile,cacheDir,ttl,workers,mergeDistance,searchFn)
+    pairs = []
+    for siteName, searchJson in siteScenes.items():
+        scenesList= get_scene_name(searchJson,catalogPath=catalogPath) #call the get_scene_name function
+        network = build_network(scenesList,neighbours,maxTemporal,maxPerpendicular) #call the build_network function
+        pairs.extend((siteName,*row) for row in network.itertuples(index=False))
+    #the pairs of all the sites are registered together so a pair shared by sites is only sent once
+    newPairs = register_pairs(pairs,conn,tName)
+    jobs = prepare_jobs(newPairs,tName)
+    print(str(len(pairs))+" site pairs, you will send "+str(len(jobs))+" jobs to ASF.")
     return jobs #returns the prepared jobs that cane be sent to ASF
 
 #sends the list of jobs created in  insar_jobs functions to ASF to be created and downloaded
 #UN:str (ASF username), PW:str (ASF password), jobs:list (list of ASF jobs), out:str (Path for save data)
+@instrument.instrumented('send_jobs')
 def send_jobs(UN,PW,jobs,out): 
     hyp3 = HyP3(username = UN, password = PW) #authenticate using ASF credentials
     batch = hyp3.submit_prepared_jobs(prepared_jobs = jobs) #send the jobs
@@ -136,69 +340,228 @@ def send_jobs(UN,PW,jobs,out):
     #Downloads files into data folder
     batch.download_files(location = out)
 
+#downloads one finished HyP3 job, unzips it and crops/reprojects its tifs to bounds, runs in a worker thread (no db access)
+#returns the product folders, the tifs that were cropped and reprojected and their outputs so the db can be updated by the caller
+#job: hyp3_sdk Job, out:str (Path for save data), newcrs:str (crs of the shapefile), bounds:tuple (crop bounds in the crs of the products, None only unzips)
+#profile:str (layout of the outputs, key of OUTPUT_PROFILES)
+def stream_product(job,out,newcrs,bounds,profile='gtiff'):
+    folders = []
+    sources = []
+    warped = []
+    for file in job.download_files(location = out):
+        #same paths as process_tifs lists in out so the catalog rows match
+        tifs = [os.path.join(out,os.path.relpath(tif,out)) for tif in unzip_product((str(file),out,PRODUCT_SUFFIXES,False))]
+        folders.extend(dict.fromkeys(os.path.dirname(tif) for tif in tifs))
+        if bounds is not None:
+            sources.extend(tifs)
+            warped.extend(warp_tif((tif,bounds,newcrs,profile)) for tif in tifs)
+    return folders, sources, warped
+
+#sends the jobs to ASF and processes each product as soon as its job finishes instead of waiting for the whole batch
+#finished jobs are downloaded, unzipped and cropped/reprojected in a pool of threads while the other jobs are still running
+#UN:str (ASF username), PW:str (ASF password), jobs:list (list of ASF jobs), out:str (Path for save data), project:str (project table name), conn: connection to db
+#shpPath:str (path to .shp file), bounds:tuple (crop bounds in the crs of the products, stored as the project grid if it has none yet)
+#without bounds the products are cropped to the project grid as they finish, a project with no grid is cropped once all jobs are done
+#workers:int (number of threads), pollInterval:int (seconds between job status checks), apiUrl:str (HyP3 api to use instead of ASF, like a local test server)
+#profile:str (layout of the outputs, key of OUTPUT_PROFILES)
+@instrument.instrumented('stream_jobs')
+def stream_jobs(UN,PW,jobs,out,project,conn,shpPath,bounds=None,workers=4,pollInterval=60,apiUrl=None,profile='gtiff'):
+    options = {'username':UN,'password':PW}
+    if apiUrl is not None:
+        options['api_url'] = apiUrl
+    hyp3 = HyP3(**options) #authenticate using ASF credentials
+    batch = hyp3.submit_prepared_jobs(prepared_jobs = jobs) #send the jobs
+    newcrs = str(gpd.GeoDataFrame.from_file(shpPath).crs)
+    #the products are cropped to the fixed grid of the project so they match the ones process_tifs makes later
+    grid = project_grid(conn,project,newcrs,bounds=bounds)
+    if bounds is not None and grid != tuple(bounds):
+        print("The project already has the grid "+str(grid)+", the products are cropped to it")
+    bounds = grid
+
+    outputKey = output_key(bounds,newcrs,profile) if bounds is not None else None
+    started = set()
+    running = {} #future of each job being processed and its job id
+    warped = []
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while True:
+            for job in batch:
+                if job.succeeded() and job.job_id not in started:
+                    started.add(job.job_id)
+                    running[pool.submit(stream_product,job,out,newcrs,bounds,profile)] = job.job_id
+                elif job.failed() and job.job_id not in started:
+                    started.add(job.job_id)
+                    print("Job failed: "+str(job.job_id))
+            done = batch.complete()
+            #the db is only updated from this thread, once every job is done wait for the products still being processed
+            for future in list(running):
+                if done or future.done():
+                    jobId = running.pop(future)
+                    #a bad download or zip only stops its own product
+                    try:
+                        folders, sources, products = future.result()
+                    except Exception as e:
+                        print("Product of job "+str(jobId)+" failed: "+repr(e))
+                        continue
+                    for folder in folders:
+                        register_insar(folder,project,conn)
+                    record_outputs(products,conn,project)
+                    catalog_outputs(conn,sources,products,outputKey)
+                    warped.extend(products)
+            if done:
+                break
+            time.sleep(pollInterval)
+            batch = hyp3.refresh(batch)
+    if bounds is None:
+        process_tifs(out,project,shpPath,conn,profile=profile)
+    print(str(len(started))+" jobs finished")
+    return warped
+
+#suffixes of the HyP3 product tifs used by the pipeline, the rest of each zip (amplitude, wrapped phase, browse images) is not extracted
+PRODUCT_SUFFIXES = ('vert_disp','corr','unw_phase','dem','lv_theta','lv_phi','water_mask')
+
+#Gets the path the outputs of a tif are written next to, tifs read inside a zip (/vsizip/) are written to the folder the zip would extract to
+def product_path(geoTif):
+    if geoTif.startswith('/vsizip/'):
+        zipPath, member = geoTif[len('/vsizip/'):].split('.zip/',1)
+        return os.path.join(os.path.dirname(zipPath), member)
+    return geoTif
+
+#Gets the file on disk that holds a tif (the zip for /vsizip/ paths)
+def source_file(geoTif):
+    if geoTif.startswith('/vsizip/'):
+        return geoTif[len('/vsizip/'):].split('.zip/',1)[0]+'.zip'
+    return geoTif
+
+#Extracts one HyP3 zip, only the tifs ending in the suffixes and the product .txt file are extracted
+#With virtual the tifs stay in the zip and are returned as /vsizip/ paths that gdal and rasterio read directly, and the zip is kept
+#args:tuple (file:str path to the zip, zipped:str folder to extract to, suffixes:tuple (None extracts everything), virtual:bool)
+def unzip_product(args):
+    file, zipped, suffixes, virtual = args
+    tifs = []
+    with ZipFile(file, 'r') as zipf:
+        if suffixes is None and not virtual:
+            zipf.extractall(zipped)
+            members = []
+        else:
+            members = zipf.namelist()
+        for member in members:
+            folder = os.path.dirname(member)
+            if member.endswith('.tif'):
+                if suffixes is not None and not member[:-len('.tif')].endswith(tuple('_'+suffix for suffix in suffixes)):
+                    continue
+                if virtual:
+                    tifs.append('/vsizip/'+os.path.abspath(file)+'/'+member)
+                else:
+                    tifs.append(zipf.extract(member,zipped))
+            elif member == folder+'/'+os.path.basename(folder)+'.txt' and not os.path.exists(os.path.join(zipped,member)):
+                zipf.extract(member,zipped) #the product .txt has the scene names for the db
+    if not virtual:
+        os.remove(file)
+    return tifs
+
 #unzip the downloaded files from ASF and delete the zipped files
-def unzip(zipped):
-    zipfiles = os.listdir(zipped)
-    #Unzips each zip file and deletes the zip
-    for x in range(len(zipfiles)):
-        file = os.path.join(zipped, zipfiles[x])
-        if file.endswith(".zip"):
-            with ZipFile(file, 'r') as zipf:
-                zipf.extractall(zipped)
-            os.remove(file)
-
-#Gets the minimum bounds of all the tif files in the files            
-def get_bounds(listTifs):
-    dataset = rio.open(listTifs[0])
+#zipped:str (folder with the zips), suffixes:tuple (tifs to extract, None extracts everything), workers:int (number of processes, None uses every core)
+#virtual:bool (keep the tifs in the zips and return /vsizip/ paths to them)
+@instrument.instrumented('unzip')
+def unzip(zipped,suffixes=PRODUCT_SUFFIXES,workers=None,virtual=False):
+    zipfiles = [os.path.join(zipped, file) for file in os.listdir(zipped) if file.endswith(".zip")]
+    jobs = [(file,zipped,suffixes,virtual) for file in zipfiles]
+    #Unzips each zip file in a process pool
+    if workers == 1 or len(jobs) < 2:
+        results = [unzip_product(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            results = list(pool.map(unzip_product,jobs))
+    tifs = [tif for tifs in results for tif in tifs]
+    instrument.count('files_read',len(zipfiles))
+    instrument.count('files_written',0 if virtual else len(tifs))
+    return tifs
+
+#Creates the raster catalog table in the project db, it stores the header of every tif so it only has to be opened once
+#conn: connection to db
+def create_catalog(conn):
+    database.transaction(conn,lambda c: c.execute("CREATE TABLE IF NOT EXISTS raster_catalog (path text PRIMARY KEY, size integer, mtime real, checksum text, crs text, left real, bottom real, right real, top real, width integer, height integer, xres real, yres real, output_path text, output_key text)"))
+
+#md5 checksum of a file read in 1 MB blocks
+def file_checksum(path):
+    md5 = hashlib.md5()
+    with open(path,'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            md5.update(block)
+    return md5.hexdigest()
+
+#Adds new or changed tifs to the raster catalog reading only their headers and returns the catalog rows of the tifs
+#A tif is only re-read when its size or mtime (and checksum if checksum is True) changed since it was cataloged
+#conn: connection to db, listTifs:list (list of all tif files), checksum:bool
+@instrument.instrumented('update_catalog')
+def update_catalog(conn,listTifs,checksum=False):
+    create_catalog(conn)
+    rows = database.read(conn,"SELECT path, size, mtime, checksum, crs, left, bottom, right, top, width, height, xres, yres, output_path, output_key FROM raster_catalog")
+    catalog = {row[0]: row for row in rows}
+    changed = []
+    for path in listTifs:
+        info = os.stat(source_file(path))
+        fileSum = file_checksum(source_file(path)) if checksum else None
+        row = catalog.get(path)
+        if row is not None and row[1] == info.st_size and row[2] == info.st_mtime and (fileSum is None or row[3] == fileSum):
+            continue
+        with rio.open(path) as dataset: #only the header is read
+            bounds = dataset.bounds
+            crs = dataset.crs.to_wkt() if dataset.crs else None
+            row = (path, info.st_size, info.st_mtime, fileSum, crs, bounds.left, bounds.bottom, bounds.right, bounds.top,
+                   dataset.width, dataset.height, dataset.res[0], dataset.res[1], None, None)
+        catalog[path] = row
+        changed.append(row)
+    #new and changed tifs lose their output so they are processed again
+    instrument.count('files_read',len(changed))
+    database.write_many(conn,"INSERT OR REPLACE INTO raster_catalog VALUES (?,?,?,?,?,?,?,?,?,?,?,?,?,?,?)",changed)
+    database.flush(conn)
+    if changed:
+        print(str(len(changed))+" tifs added to the catalog")
+    return [catalog[path] for path in listTifs]
+
+#Gets the minimum bounds of all the tif files in the files
+#conn: optional connection to db, the bounds are then taken from the raster catalog
+def get_bounds(listTifs,conn=None):
+    if conn is not None:
+        boxes = [row[5:9] for row in update_catalog(conn,listTifs)]
+    else:
+        boxes = []
+        for tif in listTifs:
+            with rio.open(tif) as dataset:
+                boundingBox = dataset.bounds
+                boxes.append((boundingBox.left,boundingBox.bottom,boundingBox.right,boundingBox.top))
     #set default bounds:
-    boundingBox = dataset.bounds
-    left = boundingBox.left
-    right = boundingBox.right
-    top = boundingBox.top
-    bottom = boundingBox.bottom
+    left, bottom, right, top = boxes[0]
     #loop through all tifs and check if they have smaller bounds
-    for x in range(1,len(listTifs)):
-        dataset = rio.open(listTifs[x])
-        boundingBox = dataset.bounds
-        if boundingBox.left < left:
-            left = boundingBox.left
-        if boundingBox.right < right:
-            right = boundingBox.right
-        if boundingBox.top < top:
-            top = boundingBox.top
-        if boundingBox.bottom < bottom:
-            bottom = boundingBox.bottom
+    for x in range(1,len(boxes)):
+        if boxes[x][0] < left:
+            left = boxes[x][0]
+        if boxes[x][2] < right:
+            right = boxes[x][2]
+        if boxes[x][3] < top:
+            top = boxes[x][3]
+        if boxes[x][1] < bottom:
+            bottom = boxes[x][1]
     minbbox = (left,bottom,right,top) #get all the min bounds
     print(minbbox)
     return minbbox
 
 #reproject the tif files to be the same crs as the shapefile (uses gdal)
-def reproject(newcrs,reprojTifs,conn,tName): #newcrs:str (crs of the shapefile), reprojTuf:list (list of all tif files), conn: connection to db, tname:str (project table name)
-    opts = gdal.WarpOptions(options=['tr'], dstSRS=newcrs, format="GTiff") #set options for gdal
+#profile:str (layout of the outputs, key of OUTPUT_PROFILES)
+def reproject(newcrs,reprojTifs,conn,tName,profile='gtiff'): #newcrs:str (crs of the shapefile), reprojTuf:list (list of all tif files), conn: connection to db, tname:str (project table name)
     #for all listed tifs:
     for geoTif in reprojTifs:
         dataset = gdal.Open(geoTif) #open the tif
-        filename = geoTif.split('.')[0]+'_reproj.tif' #add reproj.tif to the end of the file name
-        currentInsar = geoTif.split('\\')[-2]
-        gdal.Warp(filename, dataset, options=opts) #reproject tif into new crs
+        filename = os.path.splitext(geoTif)[0]+'_reproj.tif' #add reproj.tif to the end of the file name
+        currentInsar = os.path.basename(os.path.dirname(geoTif)) #the insar name is the folder of the tif
+        write_output(filename, dataset, profile, options=['tr'], dstSRS=newcrs) #reproject tif into new crs
         print(currentInsar)
         if filename.endswith("vert_disp_crop_reproj.tif"): #input path to vert displacement tifs into the db
-            try: 
-                cursor = conn.cursor()
-                cursor.execute(f"UPDATE {tName} SET vertdisp_path = ? WHERE insar_name = ?",(filename, currentInsar))
-                conn.commit()
-                cursor.close()
-            except Exception as e:
-                print(e)
+            database.write_many(conn,f"UPDATE {tName} SET vertdisp_path = ? WHERE insar_name = ?",[(filename, currentInsar)])
 
         if filename.endswith("_corr_crop_reproj.tif"): #input path to corr tif into the db
-            try: 
-                cursor = conn.cursor()
-                cursor.execute(f"UPDATE {tName} SET coherence_path = ? WHERE insar_name = ?",(filename, currentInsar))
-                conn.commit()
-                cursor.close()
-            except Exception as e:
-                print(e)
+            database.write_many(conn,f"UPDATE {tName} SET coherence_path = ? WHERE insar_name = ?",[(filename, currentInsar)])
         dataset = None #close the file
 
 def delete_double(rawdatapath):
@@ -215,61 +578,406 @@ def delete_double(rawdatapath):
                 os.remove(os.path.join(folderName,file))
 
 #crop the tifs to the minbouds from the get_bounds function (uses gdal)
-def crop_Tifs(cropTifs): #cropTifs:list (list of all tif files)
+#profile:str (layout of the outputs, key of OUTPUT_PROFILES)
+def crop_Tifs(cropTifs,profile='gtiff'): #cropTifs:list (list of all tif files)
     cropped = []
     minbbox = get_bounds(cropTifs) #call the get_bounds function returns list of minbounds
-    opts = gdal.WarpOptions(options=['tr'], outputBounds=minbbox, format="GTiff") #set options for gdal
     #for all listed tifs:
     for geoTif in cropTifs:
         dataset = gdal.Open(geoTif) #open the tif
         filename = geoTif.split('.')[0]+'_crop.tif' #add crop.tif to the end of the file name
 
-        gdal.Warp(filename, dataset, options=opts) #crop tifs to the min bounds
+        write_output(filename, dataset, profile, options=['tr'], outputBounds=minbbox) #crop tifs to the min bounds
         cropped.append(filename) #append the new name of the cropped tif file to list
         dataset = None #close the file
     return(cropped) #return list of newly cropped tifs
 
+#layouts of the processed tifs, gtiff is the original stripped and uncompressed output
+#the cog profiles write tiled cloud optimized tifs with a predictor for the float rasters and internal overviews
+#so windowed reads only fetch the tiles they need, the predictor of tiled is picked from the band type (see write_output)
+OUTPUT_PROFILES = {'gtiff':{'format':'GTiff','options':[]},
+                   'tiled':{'format':'GTiff','options':['TILED=YES','BLOCKXSIZE=256','BLOCKYSIZE=256','COMPRESS=DEFLATE'],'predictor':True},
+                   'cog':{'format':'COG','options':['COMPRESS=DEFLATE','LEVEL=6','PREDICTOR=YES','BLOCKSIZE=256','OVERVIEWS=AUTO','OVERVIEW_RESAMPLING=AVERAGE']},
+                   'cog-zstd':{'format':'COG','options':['COMPRESS=ZSTD','LEVEL=9','PREDICTOR=YES','BLOCKSIZE=256','OVERVIEWS=AUTO','OVERVIEW_RESAMPLING=AVERAGE']}}
+
+#Warps a gdal dataset into filename with the layout of an output profile
+#The COG driver can only copy a dataset, so the warp is an in-memory VRT that gdal.Translate writes out
+#filename:str, dataset: gdal dataset, profile:str (key of OUTPUT_PROFILES), warpOptions: gdal.WarpOptions keywords (dstSRS, outputBounds...)
+def write_output(filename,dataset,profile='gtiff',**warpOptions):
+    layout = OUTPUT_PROFILES[profile]
+    options = list(layout['options'])
+    if layout.get('predictor'):
+        #the floating point predictor only works on float bands, integer bands like the water mask use horizontal differencing
+        floating = dataset.GetRasterBand(1).DataType in (gdal.GDT_Float32,gdal.GDT_Float64)
+        options.append('PREDICTOR=3' if floating else 'PREDICTOR=2')
+    if layout['format'] == 'COG':
+        warped = gdal.Warp('', dataset, options=gdal.WarpOptions(format="VRT", **warpOptions))
+        gdal.Translate(filename, warped, options=gdal.TranslateOptions(format="COG", creationOptions=options))
+        warped = None
+    else:
+        gdal.Warp(filename, dataset, options=gdal.WarpOptions(format=layout['format'], creationOptions=options, **warpOptions))
+    return filename
+
+#crops and reprojects one tif with a single gdal.Warp, the crop is an in-memory VRT so no _crop.tif is written
+#args:tuple (geoTif:str path to the tif, minbbox:tuple bounds from get_bounds, newcrs:str crs of the shapefile, optional profile:str key of OUTPUT_PROFILES)
+def warp_tif(args):
+    geoTif, minbbox, newcrs = args[:3]
+    profile = args[3] if len(args) > 3 else 'gtiff'
+    filename = os.path.splitext(product_path(geoTif))[0]+'_crop_reproj.tif' #same name as crop_Tifs then reproject
+    dataset = gdal.Open(geoTif) #open the tif
+    cropped = gdal.Warp('', dataset, options=gdal.WarpOptions(outputBounds=minbbox, format="VRT")) #crop to the min bounds in memory
+    write_output(filename, cropped, profile, dstSRS=newcrs) #reproject the crop into new crs
+    cropped = None #close the files
+    dataset = None
+    return filename
+
+#Gets the fixed crop bounds of a project for a crs, the first call stores them in the db and later calls reuse them
+#so new products are cropped to the same grid and the outputs already made stay valid (delete the row to crop to new bounds)
+#conn: connection to db, tname:str (project table name), newcrs:str (crs of the shapefile)
+#listTifs:list (tifs whose bounds are stored the first time), bounds:tuple (optional bounds to store instead, in the crs of the tifs)
+#without listTifs and bounds it only looks the grid up and returns None if the project has none yet
+def project_grid(conn,tName,newcrs,listTifs=None,bounds=None):
+    database.transaction(conn,lambda c: c.execute("CREATE TABLE IF NOT EXISTS project_grid (project text, crs text, left real, bottom real, right real, top real, PRIMARY KEY (project, crs))"))
+    query = "SELECT left, bottom, right, top FROM project_grid WHERE project = ? AND crs = ?"
+    rows = database.read(conn,query,(tName,newcrs))
+    if rows:
+        return tuple(rows[0])
+    if bounds is None and listTifs is None:
+        return None
+    if bounds is None:
+        bounds = get_bounds(listTifs,conn)
+    #another process may have stored the grid first, its bounds are kept
+    database.transaction(conn,lambda c: c.execute("INSERT OR IGNORE INTO project_grid VALUES (?, ?, ?, ?, ?, ?)",(tName,newcrs,*bounds)))
+    return tuple(database.read(conn,query,(tName,newcrs))[0])
+
+#Key of the outputs of tifs cropped to bounds and reprojected to newcrs with a profile, stored in the raster catalog
+def output_key(bounds,newcrs,profile='gtiff'):
+    bounds = tuple(float(value) for value in bounds)
+    return str((bounds,newcrs)) if profile == 'gtiff' else str((bounds,newcrs,profile))
+
+#Records tifs processed outside of warp_tifs (streamed or by queue workers) in the raster catalog with their output
+#so the next warp_tifs with the same output key skips them
+#conn: connection to db, tifs:list (source tifs), warped:list (output of each tif), outputKey:str (from output_key)
+def catalog_outputs(conn,tifs,warped,outputKey):
+    if not tifs:
+        return
+    update_catalog(conn,tifs)
+    database.write_many(conn,"UPDATE raster_catalog SET output_path = ?, output_key = ? WHERE path = ?",
+                        [(warped[x],outputKey,tifs[x]) for x in range(len(tifs))])
+
+#crops and reprojects all the tifs in a process pool and then inputs the vert disp and coherence paths into the db in one transaction
+#every tif is cropped to the fixed bounds of the project (project_grid), tifs already processed with the same bounds, crs and profile
+#(recorded in the raster catalog) are skipped so new products do not make the old ones be processed again
+#warpTifs:list (list of all tif files), newcrs:str (crs of the shapefile), conn: connection to db, tname:str (project table name), workers:int (number of processes, None uses every core)
+#profile:str (layout of the outputs, key of OUTPUT_PROFILES, tifs processed with another profile are processed again)
+@instrument.instrumented('warp_tifs')
+def warp_tifs(warpTifs,newcrs,conn,tName,workers=None,profile='gtiff'):
+    minbbox = project_grid(conn,tName,newcrs,warpTifs) #calls the project_grid function returns the bounds of the project
+    outputKey = output_key(minbbox,newcrs,profile)
+    done = []
+    jobs = []
+    for row in update_catalog(conn,warpTifs):
+        if row[13] is not None and row[14] == outputKey and os.path.exists(row[13]):
+            done.append(row[13])
+        else:
+            jobs.append((row[0],minbbox,newcrs,profile))
+    print(str(len(done))+" tifs already processed, "+str(len(jobs))+" to process")
+    if workers == 1:
+        warped = [warp_tif(job) for job in jobs]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            warped = list(pool.map(warp_tif,jobs))
+    instrument.count('files_read',len(jobs))
+    instrument.count('files_written',len(jobs))
+    database.write_many(conn,"UPDATE raster_catalog SET output_path = ?, output_key = ? WHERE path = ?",
+                        [(warped[x],outputKey,jobs[x][0]) for x in range(len(jobs))])
+    warped = done + warped
+
+    record_outputs(warped,conn,tName)
+    print(str(len(jobs))+" tifs cropped and reprojected")
+    return warped
+
+#inputs the paths of the cropped and reprojected vert disp and coherence tifs into the db in one transaction, the insar name is the folder of the tif
+#warped:list (list of cropped and reprojected tifs), conn: connection to db, tname:str (project table name)
+@instrument.instrumented('record_outputs')
+def record_outputs(warped,conn,tName):
+    vertdisp = []
+    coherence = []
+    for filename in warped:
+        currentInsar = os.path.basename(os.path.dirname(filename))
+        if filename.endswith("vert_disp_crop_reproj.tif"):
+            vertdisp.append((filename,currentInsar))
+        if filename.endswith("_corr_crop_reproj.tif"):
+            coherence.append((filename,currentInsar))
+    database.write_many(conn,f"UPDATE {tName} SET vertdisp_path = ? WHERE insar_name = ?",vertdisp)
+    database.write_many(conn,f"UPDATE {tName} SET coherence_path = ? WHERE insar_name = ?",coherence)
+
+#Reads the reference and secondary scene names from the .txt file of a product
+def read_product_scenes(txtPath):
+    with open(txtPath,'r') as f:
+        lines = f.readlines()
+    scene1 = lines[0].split(' ')[2].replace('\n','')
+    scene2 = lines[1].split(' ')[2].replace('\n','')
+    return scene1, scene2
+
+#Inputs the InSAR name (the product folder name) into the db for the pair of scenes in the product .txt file
+#folderName:str (path to the product folder), project:str (project table name), conn: connection to db
+def register_insar(folderName,project,conn):
+    insarName = os.path.basename(folderName)
+    txtPath = os.path.join(folderName, insarName+'.txt')
+    if not os.path.exists(txtPath):
+        return
+    scene1, scene2 = read_product_scenes(txtPath)
+    #only pairs without an InSAR name are updated so a product is never registered twice
+    database.write_many(conn,f"UPDATE {project} SET insar_name = ? WHERE primary_scene = ? AND secondary_scene = ? AND insar_name IS NULL",[(insarName, scene1, scene2)])
+
 #Takes all tifs downloaded from ASF crops and reprojects them so they can be used in annalysis
-def process_tifs(rawdatapath,project,shpPath,conn):
-    unzip(rawdatapath)   #calls the unzip function
+#cubePath:str (optional path of a .h5 displacement cube to build after processing), workers:int (number of processes for unzipping, cropping and reprojecting)
+#virtual:bool (read the tifs inside the zips instead of extracting them), profile:str (layout of the outputs, key of OUTPUT_PROFILES)
+#mintpyDir:str (optional MintPy work folder, the MintPy input stacks are then written to its inputs folder)
+@instrument.instrumented('process_tifs')
+def process_tifs(rawdatapath,project,shpPath,conn,cubePath=None,workers=None,virtual=False,profile='gtiff',mintpyDir=None):
+    zippedTifs = unzip(rawdatapath,workers=workers,virtual=virtual)   #calls the unzip function
+    #extracted tifs are found in the folders below, virtual tifs are only in the zips
+    tifList = zippedTifs if virtual else []
     folderList = os.listdir(rawdatapath) #List of all folders downloaded
-    tifList = []
     #Loop through the folders
     for x in range(len(folderList)):
         folderName = os.path.join(rawdatapath, folderList[x])
+        if not os.path.isdir(folderName):
+            continue
         fileList = os.listdir(folderName) #list of all files in current folder
         #Loop through files in folder
         for file in fileList:
-            #Select file that ends in vert_disp.tif
-            if file.endswith(".tif"):
+            #Select the downloaded tifs (not the outputs of earlier runs)
+            if file.endswith(".tif") and not file.endswith(("_crop.tif","_reproj.tif")):
                 fileName = os.path.join(folderName, file)
                 tifList.append(fileName)
-            
-            #Select text file to get the InSAR name for the paired scenes to input into db
-            if file.startswith(folderList[x]+'.txt'):
-                fileName = os.path.join(folderName, file)
-                f = open(fileName,'r')
-                lines = f.readlines()
-                scene1 = lines[0].split(' ')
-                scene2 = lines[1].split(' ')
-            
-                pair = scene1[2].replace('\n','')+','+scene2[2].replace('\n','')
-
-                try:
-                    cursor = conn.cursor()
-                    cursor.execute(f"SELECT insar_name FROM {project} WHERE insar_name = ?",(folderList[x],))
-                    row = cursor.fetchall()
-                    if row == []:
-                        cursor.execute(f"UPDATE {project} SET insar_name = ? WHERE primary_scene = ? AND secondary_scene = ?",(folderList[x], scene1, scene2))
-                        conn.commit()
-                    cursor.close()
-                except Exception as e:
-                    print(e)
-    croppedList=crop_Tifs(tifList) #calls the crop_Tif function returns list of all cropped tifs
+
+        register_insar(folderName,project,conn) #input the InSAR name for the paired scenes into db
     shp = gpd.GeoDataFrame.from_file(shpPath)
     newcrs= str(shp.crs)
-    reproject(newcrs,croppedList,conn,project) #calls the reproject function
-    delete_double(rawdatapath)
+    warped = warp_tifs(tifList,newcrs,conn,project,workers,profile) #calls the warp_tifs function to crop and reproject in one pass
+    if mintpyDir is not None:
+        write_mintpy(warped,mintpyDir) #calls the write_mintpy function so MintPy does not have to load the tifs again
+    if cubePath is not None:
+        database.flush(conn) #the cube reads the paths just written
+        build_cube(project,conn,cubePath) #calls the build_cube function
+
+#Builds a 3-D cube (time x y x x) of all the vert disp tifs in the project so analysis can slice one file instead of opening every tif
+#The cube is chunked in small spatial tiles that hold many dates so a pixel or site timeseries is one chunked read
+#project:str (project table name), conn: connection to db, cubePath:str (path of the .h5 file), chunk:int (size of the spatial tiles)
+@instrument.instrumented('build_cube')
+def build_cube(project,conn,cubePath,chunk=64):
+    #the date of a product is the primary date of its pair, it is written with the pair and is there on tables made before reference_date
+    insars = database.read(conn,f"SELECT DISTINCT vertdisp_path, primary_date, insar_name, secondary_date from {project} where vertdisp_path IS NOT NULL ORDER BY primary_date ASC, secondary_date ASC")
+    if not insars:
+        print('No vert disp tifs recorded in '+project+', the cube was not written')
+        return None
+    #every date has to be on the same grid as the first tif
+    with rio.open(insars[0][0]) as src:
+        transform = src.transform
+        crs = src.crs.to_wkt()
+        width = src.width
+        height = src.height
+    rows = []
+    for insar in insars:
+        with rio.open(insar[0]) as src:
+            if src.transform != transform or src.width != width or src.height != height:
+                print('Skipping '+insar[0]+' (not on the cube grid)')
+                continue
+        rows.append(insar)
+
+    timeChunk = min(len(rows),64)
+    strings = h5py.string_dtype()
+    with h5py.File(cubePath,'w') as cube:
+        disp = cube.create_dataset('displacement',
+                                   shape=(len(rows),height,width),
+                                   dtype='float32',
+                                   chunks=(timeChunk,min(height,chunk),min(width,chunk)),
+                                   compression='gzip',
+                                   shuffle=True,
+                                   fillvalue=np.nan)
+        cube.create_dataset('date',data=[str(row[1]) for row in rows],dtype=strings)
+        cube.create_dataset('secondary_date',data=[str(row[3]) for row in rows],dtype=strings)
+        cube.create_dataset('insar_name',data=[str(row[2]) for row in rows],dtype=strings)
+        cube.create_dataset('vertdisp_path',data=[row[0] for row in rows],dtype=strings)
+        cube.attrs['transform'] = tuple(transform)[:6]
+        cube.attrs['crs'] = crs
+        write_stack(disp,[row[0] for row in rows],chunk,np.nan)
+    instrument.count('files_read',len(rows))
+    instrument.count('files_written')
+    print('Cube with '+str(len(rows))+' dates written to '+cubePath)
+    return cubePath
+
+#Writes tifs on one grid into a (dates x rows x cols) h5py dataset
+#A block of dates is written one strip of tiles at a time so every chunk is only written once
+#dataset: h5py dataset chunked in (dates, chunk, chunk), paths:list (one tif per date), chunk:int (rows of a strip), fill:float (value of nodata pixels)
+def write_stack(dataset,paths,chunk,fill):
+    timeChunk = dataset.chunks[0]
+    height, width = dataset.shape[1], dataset.shape[2]
+    for t0 in range(0,len(paths),timeChunk):
+        sources = [rio.open(path) for path in paths[t0:t0+timeChunk]]
+        for r0 in range(0,height,chunk):
+            window = rio.windows.Window(0,r0,width,min(chunk,height-r0))
+            strip = np.stack([src.read(1,window=window,masked=True).astype('float32').filled(fill) for src in sources])
+            dataset[t0:t0+len(sources),r0:r0+window.height,:] = strip
+        for src in sources:
+            src.close()
+
+#Gets the affine transform, width and height of the cube grid
+#cube: open h5py file from build_cube
+def cube_grid(cube):
+    disp = cube['displacement']
+    return rio.Affine(*cube.attrs['transform']), disp.shape[2], disp.shape[1]
+
+#Gets the cube index of each tif path, paths not in the cube raise an error
+#cube: open h5py file from build_cube, insars:list (paths to the vert disp tifs)
+def cube_index(cube,insars):
+    paths = cube['vertdisp_path'].asstr()[:]
+    lookup = {paths[x]: x for x in range(len(paths))}
+    missing = [path for path in insars if path not in lookup]
+    if missing:
+        raise KeyError(str(len(missing))+' tifs are not in the cube, rebuild it with build_cube: '+missing[0])
+    return np.array([lookup[path] for path in insars],dtype=int)
+
+#Reads a window of the cube for the listed dates in one read, dates can be in any order and repeat
+#cube: open h5py file from build_cube, index: array from cube_index, window: rasterio window
+def read_cube(cube,index,window):
+    unique, inverse = np.unique(index,return_inverse=True) #h5py needs increasing indices
+    data = cube['displacement'][unique,
+                                window.row_off:window.row_off+window.height,
+                                window.col_off:window.col_off+window.width]
+    return data[inverse].astype('float64')
+
+#Sentinel-1 constants MintPy needs in the attributes of its inputs (meters)
+S1_WAVELENGTH = 0.05546576
+S1_RANGE_PIXEL = 2.329562
+S1_AZIMUTH_PIXEL = 14.1
+
+#Reads the "key: value" lines of the .txt metadata file of a HyP3 product into a dict
+def read_product_metadata(txtPath):
+    metadata = {}
+    with open(txtPath,'r') as f:
+        for line in f:
+            if ':' in line:
+                key, value = line.split(':',1)
+                metadata[key.strip()] = value.strip()
+    return metadata
+
+#Groups cropped and reprojected tifs by product, returns {product folder: {suffix: path}} with the suffixes of PRODUCT_SUFFIXES
+def product_outputs(warped):
+    products = {}
+    for filename in warped:
+        name = os.path.basename(filename)[:-len('_crop_reproj.tif')]
+        for suffix in PRODUCT_SUFFIXES:
+            if name.endswith('_'+suffix):
+                products.setdefault(os.path.dirname(filename),{})[suffix] = filename
+    return products
+
+#MintPy attributes of a geocoded grid and of the metadata of a HyP3 product
+#src: open rasterio dataset, metadata:dict (from read_product_metadata)
+def mintpy_attributes(src,metadata):
+    unit = 'degrees' if src.crs is not None and src.crs.is_geographic else 'meters'
+    attrs = {'LENGTH':src.height,'WIDTH':src.width,'X_FIRST':src.transform.c,'Y_FIRST':src.transform.f,'X_STEP':src.transform.a,'Y_STEP':src.transform.e,
+             'X_UNIT':unit,'Y_UNIT':unit,'PROCESSOR':'hyp3','PLATFORM':'Sen','WAVELENGTH':S1_WAVELENGTH,'ANTENNA_SIDE':-1}
+    epsg = src.crs.to_epsg() if src.crs is not None else None
+    if epsg is not None:
+        attrs['EPSG'] = epsg
+        if 32601 <= epsg <= 32660 or 32701 <= epsg <= 32760:
+            attrs['UTM_ZONE'] = str(epsg % 100)+('N' if epsg < 32700 else 'S')
+    keys = {'HEADING':'Heading','HEIGHT':'Spacecraft height','EARTH_RADIUS':'Earth radius at nadir','STARTING_RANGE':'Slant range near',
+            'CENTER_LINE_UTC':'UTC time','ALOOKS':'Azimuth looks','RLOOKS':'Range looks'}
+    for attr, key in keys.items():
+        if key in metadata:
+            attrs[attr] = float(metadata[key])
+    if 'RLOOKS' in attrs:
+        attrs['RANGE_PIXEL_SIZE'] = S1_RANGE_PIXEL*attrs['RLOOKS']
+    if 'ALOOKS' in attrs:
+        attrs['AZIMUTH_PIXEL_SIZE'] = S1_AZIMUTH_PIXEL*attrs['ALOOKS']
+    if 'Reference Pass Direction' in metadata:
+        attrs['ORBIT_DIRECTION'] = metadata['Reference Pass Direction'].upper()
+    return attrs
+
+#Writes the MintPy inputs/ifgramStack.h5 and inputs/geometryGeo.h5 from the cropped and reprojected products so MintPy can start at modify_network
+#The stack has unwrapPhase, coherence, date, bperp and dropIfgram, the geometry has height, incidenceAngle, azimuthAngle and waterMask
+#warped:list (tifs from warp_tifs), mintpyDir:str (MintPy work folder), chunk:int (size of the spatial tiles)
+@instrument.instrumented('write_mintpy')
+def write_mintpy(warped,mintpyDir,chunk=128):
+    products = product_outputs(warped)
+    pairs = []
+    for folder, files in products.items():
+        if 'unw_phase' not in files or 'corr' not in files:
+            continue
+        parts = os.path.basename(folder).split('_') #S1AA_20170101T000000_20170113T000000_...
+        txtPath = os.path.join(folder,os.path.basename(folder)+'.txt')
+        metadata = read_product_metadata(txtPath) if os.path.exists(txtPath) else {}
+        pairs.append((parts[1][:8],parts[2][:8],files,metadata))
+    pairs.sort(key=lambda pair: (pair[0],pair[1]))
+    if not pairs:
+        print('No products with unw_phase and corr tifs for MintPy')
+        return None
+
+    #every interferogram has to be on the grid of the first one
+    with rio.open(pairs[0][2]['unw_phase']) as src:
+        grid = (src.transform,src.width,src.height)
+        attrs = mintpy_attributes(src,pairs[0][3])
+    kept = []
+    for pair in pairs:
+        with rio.open(pair[2]['unw_phase']) as src:
+            if (src.transform,src.width,src.height) != grid:
+                print('Skipping '+pair[2]['unw_phase']+' (not on the grid of the stack)')
+                continue
+        kept.append(pair)
+    pairs = kept
+    width, height = grid[1], grid[2]
+
+    inputs = os.path.join(mintpyDir,'inputs')
+    os.makedirs(inputs,exist_ok=True)
+    stackPath = os.path.join(inputs,'ifgramStack.h5')
+    dates = sorted({date for pair in pairs for date in pair[:2]})
+    with h5py.File(stackPath,'w') as stack:
+        stack.create_dataset('date',data=np.array([pair[:2] for pair in pairs],dtype='S8'))
+        stack.create_dataset('bperp',data=np.array([float(pair[3].get('Baseline','nan')) for pair in pairs],dtype='float32'))
+        stack.create_dataset('dropIfgram',data=np.ones(len(pairs),dtype=bool))
+        #HyP3 products use 0 for nodata, MintPy reads 0 phase and coherence as no data
+        for name, suffix in (('unwrapPhase','unw_phase'),('coherence','corr')):
+            dataset = stack.create_dataset(name,
+                                           shape=(len(pairs),height,width),
+                                           dtype='float32',
+                                           chunks=(min(len(pairs),32),min(height,chunk),min(width,chunk)),
+                                           compression='gzip',
+                                           shuffle=True)
+            write_stack(dataset,[pair[2][suffix] for pair in pairs],chunk,0)
+        stack.attrs.update(attrs)
+        stack.attrs.update({'FILE_TYPE':'ifgramStack','UNIT':'radian','START_DATE':dates[0],'END_DATE':dates[-1]})
+
+    #the geometry is taken from the first product that has all of it
+    geometryPath = os.path.join(inputs,'geometryGeo.h5')
+    geometryFiles = next((pair[2] for pair in pairs if all(suffix in pair[2] for suffix in ('dem','lv_theta','lv_phi'))),None)
+    if geometryFiles is None:
+        print('No product with dem, lv_theta and lv_phi tifs, geometryGeo.h5 not written')
+        geometryPath = None
+    else:
+        with h5py.File(geometryPath,'w') as geometry:
+            #lv_theta is the look vector elevation and lv_phi its angle from east (radians), MintPy wants the incidence angle and
+            #the azimuth angle from north (degrees)
+            layers = (('height','dem',lambda data: data),
+                      ('incidenceAngle','lv_theta',lambda data: 90 - np.rad2deg(data)),
+                      ('azimuthAngle','lv_phi',lambda data: np.rad2deg(data) - 90),
+                      ('waterMask','water_mask',lambda data: np.nan_to_num(data) > 0)) #1 is land
+            for name, suffix, convert in layers:
+                if suffix not in geometryFiles:
+                    continue
+                with rio.open(geometryFiles[suffix]) as src:
+                    data = convert(src.read(1,masked=True).astype('float32').filled(np.nan))
+                geometry.create_dataset(name,data=data,chunks=(min(height,chunk),min(width,chunk)),compression='gzip',shuffle=True)
+            geometry.attrs.update(attrs)
+            geometry.attrs['FILE_TYPE'] = 'geometry'
+    instrument.count('files_read',2*len(pairs))
+    instrument.count('files_written',1 if geometryPath is None else 2)
+    print('MintPy stack with '+str(len(pairs))+' interferograms written to '+stackPath)
+    return stackPath, geometryPath
 
 #selects the insars from the db given a specific time frame and site
 def get_insars(project,conn,date2,date1,shp,name):
@@ -283,38 +991,593 @@ def get_insars(project,conn,date2,date1,shp,name):
     print(d2)
     date2 = str(d2 + timedelta(weeks = 52))
     date1 = str(d2 - timedelta(weeks = 52))
-    try:
-        cursor = conn.cursor()
-        cursor.execute(f"SELECT vertdisp_path, reference_date from {project} where reference_date BETWEEN ? AND ? ORDER BY reference_date ASC",(date1,date2))
-        insars = cursor.fetchall()
-        cursor.close()
-    except Exception as e:
-        print(e)
+    insars = database.read(conn,f"SELECT vertdisp_path, reference_date from {project} where reference_date BETWEEN ? AND ? ORDER BY reference_date ASC",(date1,date2))
     return insars
 
+#Gets the window of a raster grid around a site without rasterizing it
+#site: shapely geometry, transform: affine transform of the grid, width:int, height:int
+def site_extent(site,transform,width,height):
+    left,bottom,right,top = site.bounds
+    #convert the corners of the site bounds to pixel coordinates
+    cols,rows = zip(~transform * (left,top), ~transform * (right,bottom))
+    col0 = max(int(np.floor(min(cols))),0)
+    col1 = min(int(np.ceil(max(cols))),width)
+    row0 = max(int(np.floor(min(rows))),0)
+    row1 = min(int(np.ceil(max(rows))),height)
+    return rio.windows.Window(col0, row0, max(col1-col0,0), max(row1-row0,0))
+
+#Gets the window of a raster grid around a site and the mask of the pixels in the site (all touched pixels, like rasterstats)
+#site: shapely geometry, transform: affine transform of the grid, width:int, height:int
+def site_window(site,transform,width,height):
+    window = site_extent(site,transform,width,height)
+    if window.width == 0 or window.height == 0: #site is outside of the grid
+        return window, np.zeros((window.height,window.width),dtype=bool)
+    mask = rio.features.geometry_mask([site],
+                                      out_shape=(window.height,window.width),
+                                      transform=rio.windows.transform(window,transform),
+                                      all_touched=True,
+                                      invert=True)
+    return window, mask
+
+#Reads the pixels in the site for every raster that shares one grid, nodata pixels are returned as nan
+#paths:list (rasters on the same grid), window: window from site_window, mask: mask from site_window
+def read_site_pixels(paths,window,mask):
+    values = np.full((len(paths),int(mask.sum())),np.nan)
+    if values.shape[1] == 0: #no pixels of the site on this grid
+        return values
+    for x in range(len(paths)):
+        with rio.open(paths[x]) as src:
+            data = src.read(1,window=window,masked=True)
+        values[x] = data.astype('float64').filled(np.nan)[mask]
+    instrument.count('files_read',len(paths))
+    return values
+
+#count, min, mean, max and median of every row of a (dates x pixels) array, ignoring nan
+#a site with no pixels on the grid gets count 0 and nan stats like rasterstats
+def stack_stats(values):
+    count = np.sum(~np.isnan(values),axis=1)
+    if values.shape[1] == 0: #nanmin and nanmax can not reduce an empty row
+        return np.column_stack((count,np.full((len(values),4),np.nan)))
+    with warnings.catch_warnings(): #rows with no valid pixels give nan instead of a warning
+        warnings.simplefilter('ignore',category=RuntimeWarning)
+        return np.column_stack((count,
+                                np.nanmin(values,axis=1),
+                                np.nanmean(values,axis=1),
+                                np.nanmax(values,axis=1),
+                                np.nanmedian(values,axis=1)))
+
+#Splits a window into blocks of whole rows so the float64 values of layers rasters in a block fit in memoryBudget bytes
+#with room for the masked copy and the histogram index of streamed_stats
+#window: rasterio window, memoryBudget:int (bytes), layers:int (rasters read together in a block)
+def window_blocks(window,memoryBudget,layers=1):
+    rowBytes = max(window.width,1)*layers*8*3
+    rows = max(int(memoryBudget // rowBytes),1)
+    return [rio.windows.Window(window.col_off,window.row_off+r0,window.width,min(rows,window.height-r0)) for r0 in range(0,window.height,rows)]
+
+#Mask of the pixels of a block that are in the site (all touched pixels like site_window)
+def block_mask(site,transform,block):
+    return rio.features.geometry_mask([site],
+                                      out_shape=(block.height,block.width),
+                                      transform=rio.windows.transform(block,transform),
+                                      all_touched=True,
+                                      invert=True)
+
+#Streams the pixels of a site through the blocks of a window and returns the stats of every layer like stack_stats
+#Only one block is in memory at a time. Count, min, mean and max are exact, when the window takes more than one block the
+#median comes from a second pass that fills a histogram of bins between the min and max of each layer (error below (max-min)/bins)
+#With threshold readBlock also returns the coherence of every layer (in the same window, after the layers) and the columns of
+#masked_stats are added, the masked median is streamed like the median
+#readBlock: function (block -> layers x rows x cols float64 array, nan for nodata), site: shapely geometry, transform: affine transform of the grid
+#window: window from site_window, layers:int, memoryBudget:int (bytes), bins:int (histogram bins for the median)
+#threshold:float (optional coherence threshold), weighted:bool (add the coherence weighted mean, with threshold)
+def streamed_stats(readBlock,site,transform,window,layers,memoryBudget,bins=4096,threshold=None,weighted=False):
+    masked = threshold is not None
+    #values and coherence of the site pixels of a block
+    def read(block):
+        data = readBlock(block)[:,block_mask(site,transform,block)]
+        return (data[:layers],data[layers:]) if masked else (data,None)
+    def exact(values,coherence):
+        stats = stack_stats(values)
+        return np.column_stack((stats,masked_stats(values,coherence,threshold,weighted))) if masked else stats
+    if window.width == 0 or window.height == 0: #site is outside of the grid
+        empty = np.full((layers,0),np.nan)
+        return exact(empty,empty)
+    blocks = window_blocks(window,memoryBudget,2*layers if masked else layers)
+    if len(blocks) == 1: #the whole site fits in the budget
+        return exact(*read(blocks[0]))
+
+    #the streamed rows are the values and, with threshold, the values of the pixels the coherence keeps
+    def streamed(block):
+        values, coherence = read(block)
+        if not masked:
+            return values, None
+        keep = ~np.isnan(values) & (np.nan_to_num(coherence,nan=-np.inf) >= threshold)
+        return np.concatenate((values,np.where(keep,values,np.nan))), np.where(keep,coherence,0)
+    rows = 2*layers if masked else layers
+    count = np.zeros(rows)
+    total = np.zeros(rows)
+    low = np.full(rows,np.inf)
+    high = np.full(rows,-np.inf)
+    pixels = 0
+    weightSum = np.zeros(layers)
+    weightTotal = np.zeros(layers)
+    for block in blocks:
+        values, weights = streamed(block)
+        valid = ~np.isnan(values)
+        pixels += values.shape[1]
+        count += valid.sum(axis=1)
+        total += np.where(valid,values,0).sum(axis=1)
+        low = np.minimum(low,np.where(valid,values,np.inf).min(axis=1,initial=np.inf))
+        high = np.maximum(high,np.where(valid,values,-np.inf).max(axis=1,initial=-np.inf))
+        if masked:
+            weightSum += weights.sum(axis=1)
+            weightTotal += (weights*np.nan_to_num(values[layers:])).sum(axis=1)
+
+    #second pass for the median
+    span = np.where(high > low,high-low,1.0)
+    histogram = np.zeros(rows*bins)
+    offsets = (np.arange(rows)*bins)[:,None]
+    for block in blocks:
+        values = streamed(block)[0]
+        valid = ~np.isnan(values)
+        index = np.clip((np.where(valid,values-low[:,None],0)/span[:,None]*bins).astype(int),0,bins-1)+offsets
+        histogram += np.bincount(index[valid],minlength=rows*bins)
+    histogram = histogram.reshape(rows,bins)
+    cumulative = np.cumsum(histogram,axis=1)
+    half = count/2
+    median = np.full(rows,np.nan)
+    for x in np.flatnonzero(count):
+        k = int(np.searchsorted(cumulative[x],half[x]))
+        before = cumulative[x][k-1] if k > 0 else 0
+        median[x] = low[x] + span[x]*(k+(half[x]-before)/histogram[x][k])/bins if high[x] > low[x] else low[x]
+
+    with np.errstate(invalid='ignore',divide='ignore'):
+        mean = np.where(count > 0,total/count,np.nan)
+    empty = count == 0
+    stats = np.column_stack((count,np.where(empty,np.nan,low),mean,np.where(empty,np.nan,high),median))
+    if not masked:
+        return stats
+    #masked_count, masked_mean, masked_median, weighted_mean (with weighted) and valid_fraction like masked_stats
+    columns = [stats[:layers],count[layers:],mean[layers:],median[layers:]]
+    if weighted:
+        with np.errstate(invalid='ignore',divide='ignore'):
+            columns.append(np.where(weightSum > 0,weightTotal/weightSum,np.nan))
+    columns.append(count[layers:]/pixels if pixels > 0 else np.full(layers,np.nan))
+    return np.column_stack(columns)
+
+#Reads a block of a raster as float64 with nan for nodata, a missing raster (None) is all nan
+def read_block(src,block):
+    if src is None:
+        return np.full((block.height,block.width),np.nan)
+    return src.read(1,window=block,masked=True).astype('float64').filled(np.nan)
+
+#Reads the pixels in the site of the vert disp and coherence tifs of every pair on one grid, both tifs of a pair are read
+#with the same window one after the other, nodata pixels and pairs without a coherence tif are returned as nan
+#paths:list (vert disp tifs on the same grid), coherencePaths:list (coherence tif of each pair), window and mask from site_window
+def read_site_pairs(paths,coherencePaths,window,mask):
+    values = np.full((len(paths),int(mask.sum())),np.nan)
+    coherence = np.full(values.shape,np.nan)
+    if values.shape[1] == 0: #no pixels of the site on this grid
+        return values, coherence
+    for x in range(len(paths)):
+        with rio.open(paths[x]) as src:
+            values[x] = src.read(1,window=window,masked=True).astype('float64').filled(np.nan)[mask]
+            grid = (src.transform,src.width,src.height)
+        if coherencePaths[x] is None:
+            continue
+        with rio.open(coherencePaths[x]) as src:
+            if (src.transform,src.width,src.height) != grid:
+                raise ValueError(coherencePaths[x]+' is not on the grid of '+paths[x])
+            coherence[x] = src.read(1,window=window,masked=True).astype('float64').filled(np.nan)[mask]
+    instrument.count('files_read',len(paths)+sum(path is not None for path in coherencePaths))
+    return values, coherence
+
+#Stats of the pixels with coherence of at least threshold for every row of (dates x pixels) arrays, ignoring nan
+#Returns the masked count, mean and median, the mean weighted by coherence (only with weighted) and the fraction of the site pixels kept
+def masked_stats(values,coherence,threshold,weighted=False):
+    keep = ~np.isnan(values) & (np.nan_to_num(coherence,nan=-np.inf) >= threshold)
+    masked = np.where(keep,values,np.nan)
+    count = keep.sum(axis=1)
+    with warnings.catch_warnings(): #rows with no valid pixels give nan instead of a warning
+        warnings.simplefilter('ignore',category=RuntimeWarning)
+        columns = [count,np.nanmean(masked,axis=1),np.nanmedian(masked,axis=1)]
+    if weighted:
+        weights = np.where(keep,coherence,0)
+        norm = weights.sum(axis=1)
+        with np.errstate(invalid='ignore',divide='ignore'):
+            columns.append(np.where(norm > 0,np.sum(weights*np.where(keep,values,0),axis=1)/norm,np.nan))
+    columns.append(count/values.shape[1] if values.shape[1] > 0 else np.full(len(values),np.nan))
+    return np.column_stack(columns)
+
 #calculates the zonal stats for 1 site
-def get_zonal_stats(insars,site):
-    timeseriesStats = gpd.GeoDataFrame(columns=['count','min','mean','max','median'])
+#The site is rasterized once for each grid and only the window around the site is read from each raster,
+#then the stats of the whole stack are calculated together
+#insars:list (paths to the vert disp tifs), site: shapely geometry of the site, cube:str (optional path to the cube from build_cube)
+#memoryBudget:int (optional bytes, the window is then read in blocks that fit in the budget one raster at a time, see streamed_stats)
+#coherence:list (optional coherence tif of each insar, None for pairs without one), the masked_count, masked_mean, masked_median,
+#weighted_mean (with weighted) and valid_fraction columns are then added for the pixels with coherence of at least threshold
+#with memoryBudget each block of the coherence is read with the same window as the displacement
+@instrument.instrumented('get_zonal_stats')
+def get_zonal_stats(insars,site,cube=None,memoryBudget=None,coherence=None,threshold=0.5,weighted=False):
+    columns = ['count','min','mean','max','median']
+    maskedColumns = ['masked_count','masked_mean','masked_median']+(['weighted_mean'] if weighted else [])+['valid_fraction']
+    maskThreshold = threshold if coherence is not None else None
+    if cube is not None and memoryBudget is not None:
+        #blocks of rows of every date, the coherence tifs are on the grid of the cube
+        with h5py.File(cube,'r') as openCube:
+            transform, width, height = cube_grid(openCube)
+            window = site_extent(site,transform,width,height)
+            index = cube_index(openCube,insars)
+            sources = [rio.open(path) if path is not None else None for path in coherence] if coherence is not None else []
+            try:
+                def readBlock(block):
+                    values = read_cube(openCube,index,block)
+                    if coherence is None:
+                        return values
+                    return np.concatenate((values,np.stack([read_block(src,block) for src in sources])))
+                results = streamed_stats(readBlock,site,transform,window,len(insars),memoryBudget,threshold=maskThreshold,weighted=weighted)
+            finally:
+                for src in sources:
+                    if src is not None:
+                        src.close()
+        timeseriesStats = gpd.GeoDataFrame(results[:,:len(columns)],columns=columns)
+        if coherence is not None:
+            timeseriesStats[maskedColumns] = results[:,len(columns):]
+            timeseriesStats['masked_count'] = timeseriesStats['masked_count'].astype(int)
+        timeseriesStats['count'] = timeseriesStats['count'].astype(int)
+        print(timeseriesStats['mean'])
+        return timeseriesStats
+    if cube is not None:
+        #one read of the window around the site for every date
+        with h5py.File(cube,'r') as openCube:
+            transform, width, height = cube_grid(openCube)
+            window, mask = site_window(site,transform,width,height)
+            values = np.full((len(insars),int(mask.sum())),np.nan)
+            if values.shape[1] > 0:
+                values = read_cube(openCube,cube_index(openCube,insars),window)[:,mask]
+        timeseriesStats = gpd.GeoDataFrame(stack_stats(values),columns=columns)
+        if coherence is not None:
+            #the cube only has the displacement, the coherence tifs are on the same grid
+            coherenceValues = np.full(values.shape,np.nan)
+            for x in range(len(coherence)):
+                if coherence[x] is not None and values.shape[1] > 0:
+                    with rio.open(coherence[x]) as src:
+                        coherenceValues[x] = src.read(1,window=window,masked=True).astype('float64').filled(np.nan)[mask]
+            timeseriesStats[maskedColumns] = masked_stats(values,coherenceValues,threshold,weighted)
+            timeseriesStats['masked_count'] = timeseriesStats['masked_count'].astype(int)
+        timeseriesStats['count'] = timeseriesStats['count'].astype(int)
+        print(timeseriesStats['mean'])
+        return timeseriesStats
+
+    #group the rasters by grid so the site only has to be rasterized once per grid
+    grids = {}
     for x in range(len(insars)):
-        openRaster = rxr.open_rasterio(insars[x])
-        no_zeros = openRaster.where(openRaster != 0, np.nan)
-        affine=openRaster.rio.transform()
-        currentStats = rs.zonal_stats(site,
-                                        insars[x],
-                                        affine=affine,
-                                        copy_properties=True,
-                                        all_touched=True,
-                                        stats="count min mean max median")
-        properties=currentStats[0]
-        stats = properties['count'], properties['min'], properties['mean'], properties['max'],properties['median']
-        timeseriesStats.loc[len(timeseriesStats)] = stats
-        openRaster=None
-        affine=None
-        no_zeros=None
+        with rio.open(insars[x]) as src:
+            key = (tuple(src.transform),src.width,src.height)
+        grids.setdefault(key,[]).append(x)
+
+    results = np.full((len(insars),len(columns)),np.nan)
+    maskedResults = np.full((len(insars),len(maskedColumns)),np.nan)
+    for key, rows in grids.items():
+        transform = rio.Affine(*key[0][:6])
+        if memoryBudget is not None:
+            #one raster at a time, each streamed through blocks of the window
+            window = site_extent(site,transform,key[1],key[2])
+            if window.width == 0 or window.height == 0:
+                #site is outside of this grid, streamed_stats returns count 0 and nan stats without reading so the rasters are not opened
+                empty = streamed_stats(None,site,transform,window,len(rows),memoryBudget,threshold=maskThreshold,weighted=weighted)
+                results[rows] = empty[:,:len(columns)]
+                if coherence is not None:
+                    maskedResults[rows] = empty[:,len(columns):]
+                continue
+            for x in rows:
+                with rio.open(insars[x]) as src:
+                    if coherence is None:
+                        results[x] = streamed_stats(lambda block: read_block(src,block)[None],site,transform,window,1,memoryBudget)[0]
+                        continue
+                    coherenceSource = rio.open(coherence[x]) if coherence[x] is not None else None
+                    try:
+                        if coherenceSource is not None and (coherenceSource.transform,coherenceSource.width,coherenceSource.height) != (src.transform,src.width,src.height):
+                            raise ValueError(coherence[x]+' is not on the grid of '+insars[x])
+                        #displacement and coherence of each block with the same window
+                        readBlock = lambda block: np.stack((read_block(src,block),read_block(coherenceSource,block)))
+                        pairStats = streamed_stats(readBlock,site,transform,window,1,memoryBudget,threshold=threshold,weighted=weighted)[0]
+                    finally:
+                        if coherenceSource is not None:
+                            coherenceSource.close()
+                    results[x] = pairStats[:len(columns)]
+                    maskedResults[x] = pairStats[len(columns):]
+            instrument.count('files_read',len(rows)+(sum(coherence[x] is not None for x in rows) if coherence is not None else 0))
+            continue
+        window, mask = site_window(site,transform,key[1],key[2])
+        if coherence is not None:
+            #displacement and coherence of each pair in the same pass
+            values, coherenceValues = read_site_pairs([insars[x] for x in rows],[coherence[x] for x in rows],window,mask)
+            maskedResults[rows] = masked_stats(values,coherenceValues,threshold,weighted)
+        else:
+            values = read_site_pixels([insars[x] for x in rows],window,mask)
+        results[rows] = stack_stats(values)
+
+    timeseriesStats = gpd.GeoDataFrame(results,columns=columns)
+    if coherence is not None:
+        timeseriesStats[maskedColumns] = maskedResults
+        timeseriesStats['masked_count'] = timeseriesStats['masked_count'].astype(int)
+    timeseriesStats['count'] = timeseriesStats['count'].astype(int)
     print(timeseriesStats['mean'])
     return timeseriesStats
 
-def plot_mean(insars,shp,name):
+#Gets the window to read and the weight of each pixel in the window for every point on a grid, points off the grid get None
+#points:list ((lon,lat) in the crs of the rasters), transform: affine transform of the grid, width:int, height:int
+#method:str ('nearest' pixel under the point, 'bilinear' interpolation of the 4 closest pixel centers, 'mean' of the size x size pixels around the point)
+def point_windows(points,transform,width,height,method='nearest',size=3):
+    windows = []
+    for lon, lat in points:
+        col, row = ~transform * (lon,lat)
+        if method == 'nearest':
+            col0, row0 = int(np.floor(col)), int(np.floor(row))
+            weights = np.ones((1,1))
+        elif method == 'bilinear':
+            #distances are measured from the pixel centers
+            col0, row0 = int(np.floor(col-0.5)), int(np.floor(row-0.5))
+            dx, dy = col-0.5-col0, row-0.5-row0
+            weights = np.array([[(1-dx)*(1-dy),dx*(1-dy)],[(1-dx)*dy,dx*dy]])
+        elif method == 'mean':
+            col0, row0 = int(np.floor(col))-size//2, int(np.floor(row))-size//2
+            weights = np.ones((size,size))
+        else:
+            raise ValueError("method must be 'nearest', 'bilinear' or 'mean'")
+        #clip the window to the grid
+        c0, r0 = max(col0,0), max(row0,0)
+        c1, r1 = min(col0+weights.shape[1],width), min(row0+weights.shape[0],height)
+        if c1 <= c0 or r1 <= r0:
+            windows.append((None,None))
+            continue
+        windows.append((rio.windows.Window(c0,r0,c1-c0,r1-r0),weights[r0-row0:r1-row0,c0-col0:c1-col0]))
+    return windows
+
+#Weighted average of the last two axes of a window of values ignoring nan, values:array (... x rows x cols), weights:array (rows x cols)
+def weighted_window(values,weights):
+    valid = ~np.isnan(values)
+    total = np.sum(np.where(valid,values,0)*weights,axis=(-2,-1))
+    norm = np.sum(valid*weights,axis=(-2,-1))
+    with np.errstate(invalid='ignore',divide='ignore'):
+        return np.where(norm > 0,total/norm,np.nan)
+
+#Samples the stack of vert disp tifs at many points reading only the pixels that are needed, returns a dates x points array
+#The pixel offsets are only calculated once for each grid
+#insars:list (paths to the vert disp tifs), points:list ((lon,lat) in the crs of the rasters), method:str (see point_windows), size:int (window for 'mean')
+#cube:str (optional path to the cube from build_cube, every point is then one read of all the dates)
+@instrument.instrumented('sample_points')
+def sample_points(insars,points,method='nearest',size=3,cube=None):
+    samples = np.full((len(insars),len(points)),np.nan)
+    if cube is not None:
+        with h5py.File(cube,'r') as openCube:
+            transform, width, height = cube_grid(openCube)
+            index = cube_index(openCube,insars)
+            windows = point_windows(points,transform,width,height,method,size)
+            for p in range(len(points)):
+                window, weights = windows[p]
+                if window is not None:
+                    samples[:,p] = weighted_window(read_cube(openCube,index,window),weights)
+        return samples
+
+    gridWindows = {}
+    for x in range(len(insars)):
+        with rio.open(insars[x]) as src:
+            key = (tuple(src.transform),src.width,src.height)
+            if key not in gridWindows:
+                gridWindows[key] = point_windows(points,src.transform,src.width,src.height,method,size)
+            windows = gridWindows[key]
+            for p in range(len(points)):
+                window, weights = windows[p]
+                if window is not None:
+                    data = src.read(1,window=window,masked=True).astype('float64').filled(np.nan)
+                    samples[x,p] = weighted_window(data,weights)
+    return samples
+
+#Gets the window around all the sites and the pixels of every site in it (all touched pixels, like site_window)
+#Every site is rasterized on its own so a pixel shared by sites that touch counts for each of them, like get_zonal_stats
+#Returns the window, the flat index of each pixel in the window and the site (row of sites) of each pixel
+#sites: GeoSeries of site geometries, transform: affine transform of the grid, width:int, height:int
+def site_labels(sites,transform,width,height):
+    window = site_extent(box(*sites.total_bounds),transform,width,height)
+    pixels = []
+    labels = []
+    if window.width > 0 and window.height > 0:
+        for x in range(len(sites)):
+            siteWindow, mask = site_window(sites.iloc[x],transform,width,height)
+            rows, cols = np.nonzero(mask)
+            pixels.append((rows+siteWindow.row_off-window.row_off)*window.width + cols+siteWindow.col_off-window.col_off)
+            labels.append(np.full(len(rows),x))
+    pixels = np.concatenate(pixels) if pixels else np.zeros(0,dtype='int64')
+    labels = np.concatenate(labels) if labels else np.zeros(0,dtype='int64')
+    return window, pixels, labels
+
+#count, min, mean, max and median of every site in one grouped reduction, rows with no valid pixels are nan
+#labels: array of the site of each value (0 to nSites-1), values: array of pixel values (same size as labels), nSites:int
+def grouped_stats(labels,values,nSites):
+    valid = ~np.isnan(values)
+    labels = labels[valid]
+    values = values[valid]
+    #sort by site then value so min, max and median can be taken from each group's position
+    order = np.lexsort((values,labels))
+    labels = labels[order]
+    values = values[order]
+    count = np.bincount(labels,minlength=nSites)
+    total = np.bincount(labels,weights=values,minlength=nSites)
+    start = np.concatenate(([0],np.cumsum(count)[:-1]))
+    has = count > 0
+    results = np.full((nSites,5),np.nan)
+    results[:,0] = count
+    results[has,1] = values[start[has]]
+    results[has,2] = total[has] / count[has]
+    results[has,3] = values[start[has]+count[has]-1]
+    results[has,4] = (values[start[has]+(count[has]-1)//2] + values[start[has]+count[has]//2]) / 2
+    return results
+
+#calculates the zonal stats for every site in the shapefile reading each vert disp tif only once
+#Returns a long table with one row per site and InSAR
+#project:str (project table name), conn: connection to db, shp:str (path to .shp file), cube:str (optional path to the cube from build_cube)
+#memoryBudget:int (optional bytes, every site is then streamed on its own with get_zonal_stats instead of reading the window around all the sites)
+#threshold:float (optional coherence threshold, every site then gets the coherence masked columns of get_zonal_stats), weighted:bool (add the coherence weighted mean)
+@instrument.instrumented('all_sites_stats')
+def all_sites_stats(project,conn,shp,cube=None,memoryBudget=None,threshold=None,weighted=False):
+    proj = gpd.GeoDataFrame.from_file(shp)
+    siteIds = {proj['Name'][x]: x for x in range(len(proj))}
+    columns = ['count','min','mean','max','median']
+    insars = database.read(conn,f"SELECT DISTINCT vertdisp_path, reference_date, site from {project} where vertdisp_path IS NOT NULL ORDER BY reference_date ASC")
+    if memoryBudget is not None or threshold is not None:
+        pairs = database.read(conn,f"SELECT DISTINCT vertdisp_path, reference_date, site, coherence_path from {project} where vertdisp_path IS NOT NULL ORDER BY reference_date ASC")
+        rows = []
+        for site, siteId in siteIds.items():
+            sitePairs = [row for row in pairs if row[2] == site]
+            if not sitePairs:
+                continue
+            coherence = [row[3] for row in sitePairs] if threshold is not None else None
+            siteStats = get_zonal_stats([row[0] for row in sitePairs],proj['geometry'][siteId],cube,memoryBudget,coherence,threshold,weighted)
+            siteColumns = [column for column in siteStats.columns if column != 'geometry']
+            rows.extend((site,row[1],row[0],*values) for row, values in zip(sitePairs,siteStats[siteColumns].itertuples(index=False)))
+        table = pd.DataFrame(rows,columns=['site','reference_date','vertdisp_path']+siteColumns) if rows else pd.DataFrame(columns=['site','reference_date','vertdisp_path']+columns)
+        table['count'] = table['count'].astype(int)
+        return table.sort_values('reference_date',kind='stable').reset_index(drop=True)
+
+    #stats of all the sites for each tif, the site pixels are only found once per grid
+    labelCache = {}
+    pathStats = {}
+    paths = list(dict.fromkeys(row[0] for row in insars))
+    instrument.count('files_read',1 if cube is not None else len(paths))
+    if cube is not None:
+        #one read of the window around all the sites for every date
+        with h5py.File(cube,'r') as openCube:
+            transform, width, height = cube_grid(openCube)
+            window, pixels, labels = site_labels(proj.geometry,transform,width,height)
+            data = np.zeros((len(paths),0))
+            if pixels.size > 0:
+                data = read_cube(openCube,cube_index(openCube,paths),window).reshape(len(paths),-1)[:,pixels]
+        for x in range(len(paths)):
+            pathStats[paths[x]] = grouped_stats(labels,data[x],len(proj))
+    else:
+        for path in paths:
+            with rio.open(path) as src:
+                key = (tuple(src.transform),src.width,src.height)
+                if key not in labelCache:
+                    labelCache[key] = site_labels(proj.geometry,src.transform,src.width,src.height)
+                window, pixels, labels = labelCache[key]
+                if pixels.size == 0:
+                    pathStats[path] = grouped_stats(labels,np.zeros(0),len(proj))
+                    continue
+                data = src.read(1,window=window,masked=True).astype('float64').filled(np.nan)
+            pathStats[path] = grouped_stats(labels,data.ravel()[pixels],len(proj))
+
+    rows = []
+    for path, date, site in insars:
+        if site in siteIds:
+            rows.append((site,date,path,*pathStats[path][siteIds[site]]))
+    table = pd.DataFrame(rows,columns=['site','reference_date','vertdisp_path']+columns)
+    table['count'] = table['count'].astype(int)
+    return table
+
+#Gets the pairs of the project (or of one site) with their vert disp tif, primary and secondary dates, ordered by date
+#project:str (project table name), conn: connection to db, site:str (optional site name)
+def network_pairs(project,conn,site=None):
+    query = f"SELECT DISTINCT vertdisp_path, primary_date, secondary_date from {project} where vertdisp_path IS NOT NULL AND primary_date IS NOT NULL AND secondary_date IS NOT NULL"
+    params = ()
+    if site is not None:
+        query += " AND site = ?"
+        params = (site,)
+    return database.read(conn,query+" ORDER BY primary_date ASC, secondary_date ASC",params)
+
+#Design matrix of a network of pairs, the displacement of a pair is the displacement of its secondary date minus its primary date
+#The first date is the reference (zero displacement) so the unknowns are the dates after it
+#pairs:list ((primary date, secondary date)), returns the sorted dates and the (pairs x dates-1) matrix
+def design_matrix(pairs):
+    dates = sorted({date for pair in pairs for date in pair})
+    position = {dates[x]: x-1 for x in range(len(dates))}
+    matrix = np.zeros((len(pairs),len(dates)-1))
+    for x in range(len(pairs)):
+        primary, secondary = position[pairs[x][0]], position[pairs[x][1]]
+        if secondary >= 0:
+            matrix[x,secondary] += 1
+        if primary >= 0:
+            matrix[x,primary] -= 1
+    return dates, matrix
+
+#Least squares inversion of the pair displacements of many pixels at once, returns the (dates x pixels) cumulative displacement
+#Pixels with the same valid pairs share one pseudo inverse so a block only needs a few factorizations. Dates that no valid pair of a pixel
+#touches are nan, a network split in parts gets the minimum norm solution (like MintPy without its gap filling)
+#matrix: design matrix from design_matrix, values:array (pairs x pixels, nan for no data)
+def invert_network(matrix,values):
+    result = np.full((matrix.shape[1]+1,values.shape[1]),np.nan)
+    if values.shape[1] == 0:
+        return result
+    valid = ~np.isnan(values)
+    patterns, inverse = np.unique(valid.T,axis=0,return_inverse=True)
+    inverse = inverse.ravel()
+    for k in range(len(patterns)):
+        pattern = patterns[k]
+        if not pattern.any():
+            continue
+        pixels = np.flatnonzero(inverse == k)
+        subMatrix = matrix[pattern]
+        solution = np.linalg.pinv(subMatrix) @ values[pattern][:,pixels]
+        solution[~subMatrix.any(axis=0)] = np.nan #dates without a pair
+        result[0,pixels] = 0 #reference date
+        result[1:,pixels] = solution
+    return result
+
+#Displacement history of a site from the SBAS inversion of its pair stats, returns a dataframe of Date and displacement (meters)
+#The mean (or another column of get_zonal_stats) of the site for every pair is inverted for the cumulative displacement of every date
+#project:str (project table name), conn: connection to db, shp:str (path to .shp file), name:str (site name), statistic:str (column of get_zonal_stats)
+#cube:str (optional path to the cube from build_cube), memoryBudget:int (optional bytes for get_zonal_stats)
+@instrument.instrumented('sbas_site')
+def sbas_site(project,conn,shp,name,statistic='mean',cube=None,memoryBudget=None):
+    proj = gpd.GeoDataFrame.from_file(shp)
+    site = proj['geometry'][list(proj['Name']).index(name)]
+    pairs = network_pairs(project,conn,name)
+    if not pairs:
+        return pd.DataFrame(columns=['Date','displacement'])
+    stats = get_zonal_stats([pair[0] for pair in pairs],site,cube,memoryBudget)
+    dates, matrix = design_matrix([(pair[1],pair[2]) for pair in pairs])
+    history = invert_network(matrix,stats[statistic].to_numpy(dtype='float64')[:,None])[:,0]
+    return pd.DataFrame({'Date':pd.to_datetime(dates),'displacement':history})
+
+#Displacement history of every pixel of the cube (or of the window around a site) from the SBAS inversion of all the project pairs
+#The cube is read in blocks of rows that fit in memoryBudget and the history is written to a (dates x rows x cols) h5 file with the
+#date, transform and crs of the grid, like a MintPy timeseries.h5
+#project:str (project table name), conn: connection to db, cube:str (path to the cube from build_cube), outPath:str (path of the .h5 file)
+#site: optional shapely geometry (only the window around it is inverted), memoryBudget:int (bytes of pair displacements read at once)
+@instrument.instrumented('sbas_pixels')
+def sbas_pixels(project,conn,cube,outPath,site=None,memoryBudget=256*2**20):
+    pairs = network_pairs(project,conn)
+    dates, matrix = design_matrix([(pair[1],pair[2]) for pair in pairs])
+    with h5py.File(cube,'r') as openCube:
+        transform, width, height = cube_grid(openCube)
+        window = rio.windows.Window(0,0,width,height) if site is None else site_extent(site,transform,width,height)
+        if window.width == 0 or window.height == 0:
+            raise ValueError('the site is outside of the cube')
+        index = cube_index(openCube,[pair[0] for pair in pairs])
+        with h5py.File(outPath,'w') as output:
+            series = output.create_dataset('timeseries',
+                                           shape=(len(dates),window.height,window.width),
+                                           dtype='float32',
+                                           chunks=(len(dates),min(window.height,64),min(window.width,64)),
+                                           compression='gzip',
+                                           shuffle=True,
+                                           fillvalue=np.nan)
+            output.create_dataset('date',data=[str(date) for date in dates],dtype=h5py.string_dtype())
+            output.attrs['transform'] = tuple(rio.windows.transform(window,transform))[:6]
+            output.attrs['crs'] = openCube.attrs['crs']
+            output.attrs['unit'] = 'm'
+            for block in window_blocks(window,memoryBudget,len(pairs)):
+                values = read_cube(openCube,index,block).reshape(len(pairs),-1)
+                history = invert_network(matrix,values)
+                r0 = block.row_off-window.row_off
+                series[:,r0:r0+block.height,:] = history.reshape(len(dates),block.height,block.width)
+    print('Displacement history of '+str(len(dates))+' dates from '+str(len(pairs))+' pairs written to '+outPath)
+    return outPath
+
+#cube:str (optional path to the cube from build_cube), memoryBudget:int (optional bytes for get_zonal_stats)
+def plot_mean(insars,shp,name,cube=None,memoryBudget=None):
     x=[]
     pathInSAR =[]
     for z in range(len(insars)):
@@ -331,7 +1594,7 @@ def plot_mean(insars,shp,name):
             break
     conDate = np.datetime64(date)
     d2 = datetime.strptime(date, '%Y-%m-%d')
-    stats = get_zonal_stats(pathInSAR,index)
+    stats = get_zonal_stats(pathInSAR,index,cube,memoryBudget)
     fig, ax = plt.subplots(2, 2, figsize=(28, 10))
     plt.rcParams.update({'font.size': 30})
     #mean
@@ -354,131 +1617,185 @@ def plot_mean(insars,shp,name):
     plt.show()
     return stats
 
-def all_sites(project,conn,shp):
+#Draws the mean, median, min and max of a site on a 2x2 grid of axes with the enrichment date marked
+#ax: 2x2 array of matplotlib axes, date:str (enrichment date), x:list (dates of the InSARs), stats: dataframe from get_zonal_stats
+def draw_site_stats(ax,date,x,stats):
+    d1 = datetime.strptime(date, '%Y-%m-%d')
+    m=d1.month #month of enrichment
+    d2 = d1 + relativedelta(months = 6) 
+    m2 = d2.month
+    conDate = np.datetime64(date)
+    for axis, stat in zip(ax.flat,['mean','median','min','max']):
+        axis.plot(x,stats[stat])
+        axis.xaxis.set_major_locator(mdates.MonthLocator(bymonth=(m, m2)))
+        axis.xaxis.set_minor_locator(mdates.MonthLocator())
+        axis.axvline(x = conDate, color = 'r', label = 'axvline - full height')
+        axis.set_xlabel('Date')
+        axis.set_ylabel('Displacement (meters)')
+        axis.set_title(stat)
+        axis.grid(True)
+
+#plots the stats of every site, singlePass:bool (read every tif once for all the sites and return the stats table), cube:str (optional path to the cube from build_cube)
+#memoryBudget:int (optional bytes for get_zonal_stats)
+def all_sites(project,conn,shp,singlePass=False,cube=None,memoryBudget=None):
     proj = gpd.GeoDataFrame.from_file(shp)
-    
+    if singlePass:
+        table = all_sites_stats(project,conn,shp,cube,memoryBudget)
+
     for sites in range(len(proj)):
         name = proj['Name'][sites]
         index = proj['geometry'][sites]
         print(name)
         date = proj['Date'][sites]
-        d1 = datetime.strptime(date, '%Y-%m-%d')
-        m=d1.month #month of enrichment
-        d2 = d1 + relativedelta(months = 6) 
-        m2 = d2.month
-        conDate = np.datetime64(date)
-
-        #Get all insars for the site
-        try:
-            cursor = conn.cursor()
-            cursor.execute(f"SELECT vertdisp_path, reference_date from {project} where site = ? ORDER BY reference_date ASC",(name,))
-            insars = cursor.fetchall()
-            cursor.close()
-        except Exception as e:
-            print(e)
-
-        pathInSAR =[]
-        x=[]
-        for z in range(len(insars)):
-            pathInSAR.append(insars[z][0])
-            convertString = str(insars[z][1])
-            convert = np.datetime64(convertString)
-            x.append(convert)
-        stats = get_zonal_stats(pathInSAR,index) #calls zonal stats function
 
-        fig, ax = plt.subplots(2, 2, figsize=(10, 7))
-        fig.tight_layout(h_pad=3.5,w_pad=3.5)
+        if singlePass:
+            siteTable = table[table['site'] == name]
+            x = [np.datetime64(str(refDate)) for refDate in siteTable['reference_date']]
+            stats = siteTable[['count','min','mean','max','median']].reset_index(drop=True)
+        else:
+            #Get all insars for the site
+            insars = database.read(conn,f"SELECT vertdisp_path, reference_date from {project} where site = ? ORDER BY reference_date ASC",(name,))
 
-        #plot the mean
-        y = (stats['mean'])
-        ax=plt.subplot(2,2,1)
-        ax.plot(x,y)
-        ax.xaxis.set_major_locator(mdates.MonthLocator(bymonth=(m, m2)))
-        ax.xaxis.set_minor_locator(mdates.MonthLocator())
-        plt.axvline(x = conDate, color = 'r', label = 'axvline - full height')
-        ax.grid(True)
-        plt.xlabel('Date')
-        plt.ylabel('Displacement (meters)')
-        plt.title('mean')
-        plt.grid(True)
-        
-        #plot the median
-        y = (stats['median'])
-        ax = plt.subplot(2,2,2)
-        ax.plot(x,y)
-        ax.xaxis.set_major_locator(mdates.MonthLocator(bymonth=(m, m2)))
-        ax.xaxis.set_minor_locator(mdates.MonthLocator())
-        plt.axvline(x = conDate, color = 'r', label = 'axvline - full height')
-        plt.xlabel('Date')
-        plt.ylabel('Displacement(meters)')
-        plt.title('median')
-        plt.grid(True)
-
-        #plot the min
-        y = (stats['min'])
-        ax = plt.subplot(2,2,3)
-        ax.plot(x,y)
-        ax.xaxis.set_major_locator(mdates.MonthLocator(bymonth=(m, m2)))
-        ax.xaxis.set_minor_locator(mdates.MonthLocator())
-        plt.axvline(x = conDate, color = 'r', label = 'axvline - full height')
-        plt.xlabel('Date')
-        plt.ylabel('Displacement(meters)')
-        plt.title('min')
-        plt.grid(True)
-
-        #plot the max
-        y = (stats['max'])
-        ax = plt.subplot(2,2,4)
-        ax.plot(x,y)
-        ax.xaxis.set_major_locator(mdates.MonthLocator(bymonth=(m, m2)))
-        ax.xaxis.set_minor_locator(mdates.MonthLocator())
-        plt.axvline(x = conDate, color = 'r', label = 'axvline - full height')
-        plt.xlabel('Date')
-        plt.ylabel('Displacement(meters)')
-        plt.title('max')
-        plt.grid(True)
+            pathInSAR =[]
+            x=[]
+            for z in range(len(insars)):
+                pathInSAR.append(insars[z][0])
+                convertString = str(insars[z][1])
+                convert = np.datetime64(convertString)
+                x.append(convert)
+            stats = get_zonal_stats(pathInSAR,index,cube,memoryBudget) #calls zonal stats function
 
+        fig, ax = plt.subplots(2, 2, figsize=(10, 7))
+        fig.tight_layout(h_pad=3.5,w_pad=3.5)
+        draw_site_stats(ax,date,x,stats)
         fig.suptitle(name)
         plt.subplots_adjust(top=0.90)
         plt.show()
-        print(stats.mean(stats['count']))
-'''
-def run_mintpy():
-    subprocess.run(["smallbaselineApp.py","mintpyConfigFile.txt"])
-    subprocess.run(["smallbaselineApp.py", "--dostep", "velocity", "mintpyConfigFile.txt"])'''
+        print(stats['count'].mean())
+    if singlePass:
+        return table
+#figure reused for every page a report worker draws
+reportFigure = None
+
+#starts a report worker with the headless Agg backend
+def report_worker_init():
+    plt.switch_backend('Agg')
+
+#Draws and saves the page of one site in a report worker, the worker's figure and axes are cleared and reused for every site
+#args:tuple (name:str, date:str (enrichment date), x:list (dates of the InSARs), stats: dataframe, outDir:str, formats:tuple (file types like 'png' and 'pdf'))
+def render_site_page(args):
+    global reportFigure
+    name, date, x, stats, outDir, formats = args
+    if reportFigure is None:
+        reportFigure, ax = plt.subplots(2, 2, figsize=(10, 7))
+    for axis in reportFigure.axes:
+        axis.cla()
+    draw_site_stats(np.array(reportFigure.axes).reshape(2,2),date,x,stats)
+    reportFigure.suptitle(name)
+    reportFigure.tight_layout(h_pad=3.5,w_pad=3.5)
+    reportFigure.subplots_adjust(top=0.90)
+    pages = []
+    for fileType in formats:
+        page = os.path.join(outDir,str(name).replace(os.sep,'_')+'.'+fileType)
+        reportFigure.savefig(page)
+        pages.append(page)
+    return pages
+
+#Renders the stats pages of every site without a display and writes an index.html linking them
+#The stats of all the sites are computed once with all_sites_stats and the pages are drawn in a pool of processes
+#project:str (project table name), conn: connection to db, shp:str (path to .shp file), outDir:str (folder of the report)
+#workers:int (number of processes, None uses every core), formats:tuple (file types of the pages), cube:str (optional path to the cube from build_cube)
+@instrument.instrumented('render_reports')
+def render_reports(project,conn,shp,outDir,workers=None,formats=('png',),cube=None):
+    os.makedirs(outDir,exist_ok=True)
+    proj = gpd.GeoDataFrame.from_file(shp)
+    table = all_sites_stats(project,conn,shp,cube)
+    tasks = []
+    for sites in range(len(proj)):
+        name = proj['Name'][sites]
+        siteTable = table[table['site'] == name]
+        x = [np.datetime64(str(refDate)) for refDate in siteTable['reference_date']]
+        stats = siteTable[['count','min','mean','max','median']].reset_index(drop=True)
+        tasks.append((name,proj['Date'][sites],x,stats,outDir,tuple(formats)))
+    with ProcessPoolExecutor(max_workers=workers,initializer=report_worker_init) as pool:
+        pages = list(pool.map(render_site_page,tasks,chunksize=max(1,len(tasks)//(4*(workers or os.cpu_count() or 1)))))
+
+    #index of every site with its pages
+    rows = []
+    for task, sitePages in zip(tasks,pages):
+        siteTable = table[table['site'] == task[0]]
+        links = ' '.join(f'<a href="{os.path.basename(page)}">{os.path.splitext(page)[1][1:]}</a>' for page in sitePages)
+        image = [page for page in sitePages if page.endswith('.png')]
+        thumbnail = f'<img src="{os.path.basename(image[0])}" width="400">' if image else ''
+        rows.append(f'<tr><td>{task[0]}</td><td>{task[1]}</td><td>{len(siteTable)}</td><td>{siteTable["count"].mean():.1f}</td><td>{links}</td><td>{thumbnail}</td></tr>')
+    index = os.path.join(outDir,'index.html')
+    with open(index,'w') as f:
+        f.write(f'<html><head><title>{project}</title></head><body><h1>{project}</h1>\n<table border="1">\n')
+        f.write('<tr><th>Site</th><th>Enrichment</th><th>InSARs</th><th>Mean pixel count</th><th>Pages</th><th></th></tr>\n')
+        f.write('\n'.join(rows))
+        f.write('\n</table></body></html>\n')
+    print(str(len(tasks))+" site pages written to "+outDir)
+    return index
+
+#Runs MintPy on the stacks written by write_mintpy, the load_data step is skipped
+#mintpyDir:str (MintPy work folder given to process_tifs), config:str (MintPy config file)
+def run_mintpy(mintpyDir,config='mintpyConfigFile.txt'):
+    subprocess.run(["smallbaselineApp.py", os.path.abspath(config), "--dir", mintpyDir, "--start", "modify_network"],check=True)
 
 
 
+#Reads a GNSS station file (.tenv3 with YYMMMDD and __height(m) columns) into a typed dataframe with a Date column
+#The parsed file is cached as path.parquet and only parsed again when the text file is newer than the cache
+#path:str (path to the station file), cache:bool
+@instrument.instrumented('load_gnss')
+def load_gnss(path,cache=True):
+    cachePath = path+'.parquet'
+    if cache and os.path.exists(cachePath) and os.path.getmtime(cachePath) >= os.path.getmtime(path):
+        return pd.read_parquet(cachePath)
+    gps = pd.read_csv(path,sep=r'\s+') #numeric columns are read as numbers
+    gps['Date'] = pd.to_datetime(gps['YYMMMDD'],format='%y%b%d')
+    if cache:
+        gps.to_parquet(cachePath,index=False)
+    return gps
+
 #Testing GNSS mapping:
 def parseGNSSData(path):
     #create dataframe of gps data
-    textData = open(path,'r')
-    lines = textData.readlines()
-    textData.close()
-    headers = lines[0].split() #get the headings from the text file
-    lines.pop(0)
-    x = []
-    for line in lines:
-        newLine=line.split()
-        x.append(newLine)
-    Df = pd.DataFrame(x, columns=headers) #dataframe created fromm gps
-    return Df
-    
-
-def mapGNSS(project,conn,shp,name,gpsPath,data):
-    gpsDf = parseGNSSData(gpsPath) #Call function to turn GNSS text file to a dataframe
-    lat = float(gpsDf['_latitude(deg)'][0]) #latitude of the GNSS station
-    lon = float(gpsDf['_longitude(deg)'][0]) #longitude if the GNSS station
+    return load_gnss(path)
+
+#Gets the daily height change of a GNSS station (height of the day before minus height of the day) between start and end
+#gps: dataframe from load_gnss, start and end: dates (None for no limit)
+def gnss_changes(gps,start=None,end=None):
+    heights = gps['__height(m)'].to_numpy()
+    changes = pd.DataFrame({'Date':gps['Date'].to_numpy()[1:],'Height':heights[:-1] - heights[1:]})
+    keep = np.ones(len(changes),dtype=bool)
+    if start is not None:
+        keep &= changes['Date'].to_numpy() >= np.datetime64(start)
+    if end is not None:
+        keep &= changes['Date'].to_numpy() <= np.datetime64(end)
+    return changes[keep].reset_index(drop=True)
+
+#Sums the GNSS height changes between consecutive InSAR dates, the first date gets the change of that day
+#gps: dataframe from load_gnss, dates:list (InSAR reference dates in order), returns a dataframe of Date and Height
+def align_gnss(gps,dates):
+    dates = np.asarray(dates,dtype='datetime64[D]')
+    changes = gnss_changes(gps)
+    changeDates = changes['Date'].to_numpy().astype('datetime64[D]')
+    total = np.concatenate(([0.0],np.cumsum(changes['Height'].to_numpy())))
+    #sum of every change up to and including a date
+    upTo = lambda day: total[np.searchsorted(changeDates,day,side='right')]
+    previous = np.concatenate(([dates[0] - np.timedelta64(1,'D')],dates[:-1])) if len(dates) else dates
+    return pd.DataFrame({'Date':dates,'Height':upTo(dates) - upTo(previous)})
+
+#cube:str (optional path to the cube from build_cube), memoryBudget:int (optional bytes for get_zonal_stats)
+def mapGNSS(project,conn,shp,name,gpsPath,data,cube=None,memoryBudget=None):
+    gpsDf = load_gnss(gpsPath) #Call function to turn GNSS text file to a dataframe
+    lat = gpsDf['_latitude(deg)'].iloc[0] #latitude of the GNSS station
+    lon = gpsDf['_longitude(deg)'].iloc[0] #longitude if the GNSS station
     print(lat,lon)
 
     #Getting all InSARs for sites
-    try:
-        cursor = conn.cursor()
-        cursor.execute(f"SELECT DISTINCT vertdisp_path, reference_date from {project} ORDER BY reference_date ASC")
-        insars = cursor.fetchall()
-        cursor.close()
-    except Exception as e:
-        print(e)
+    insars = database.read(conn,f"SELECT DISTINCT vertdisp_path, reference_date from {project} ORDER BY reference_date ASC")
 
     pathInSARAll =[]
     xAll=[]
@@ -499,13 +1816,7 @@ def mapGNSS(project,conn,shp,name,gpsPath,data):
             index = proj['geometry'][z]
             break
     print(site)
-    try:
-        cursor = conn.cursor()
-        cursor.execute(f"SELECT vertdisp_path, reference_date from {project} where site = ? ORDER BY reference_date ASC",(name,))
-        insars = cursor.fetchall()
-        cursor.close()
-    except Exception as e:
-        print(e)
+    insars = database.read(conn,f"SELECT vertdisp_path, reference_date from {project} where site = ? ORDER BY reference_date ASC",(name,))
        
     pathInSARSite =[]
     xSite=[]
@@ -515,57 +1826,18 @@ def mapGNSS(project,conn,shp,name,gpsPath,data):
         convert = np.datetime64(convertString)
         xSite.append(convert)
 
-    stats = get_zonal_stats(pathInSARSite,index) #calls zonal stats function
+    stats = get_zonal_stats(pathInSARSite,index,cube,memoryBudget) #calls zonal stats function
     conDate = np.datetime64(date)
     print('Checkpoint2')
     #Get a timeseries of the point at lat,lon of GNSS station
-    dispTS =[]
-    for tif in pathInSARAll:
-        openraster =gdal.Open(tif)
-        transform = openraster.GetGeoTransform()
-        xOrigin = transform[0]
-        yOrigin = transform[3]
-        pixelWidth = transform[1]
-        pixelHeight = transform[5]
-
-        band = openraster.GetRasterBand(1)
-        data = band.ReadAsArray()
-        openraster=None
-        xOffset = int((lon - xOrigin) / pixelWidth)
-        yOffset = int((lat - yOrigin) / pixelHeight)
-        # get individual pixel values
-        value = data[yOffset][xOffset]
-        dispTS.append(value) #timeseries for the one point
+    dispTS = list(sample_points(pathInSARAll,[(lon,lat)],cube=cube)[:,0]) #timeseries for the one point
 
     #get timeseries for gnss data
     start = np.datetime64(xAll[0])
     end = np.datetime64(xAll[-1])
 
-    gpsList=[]
- 
-    for i in range(len(gpsDf)-1):
-        dateAll = datetime.strptime(gpsDf['YYMMMDD'][i+1], '%y%b%d')
-        convertAll = np.datetime64(dateAll)
-        diff = float(gpsDf['__height(m)'][i]) - float(gpsDf['__height(m)'][i+1])
-        if convertAll >= start and convertAll <= end:
-            row = [convertAll,diff]
-            gpsList.append(row)
-
-    gpsData = pd.DataFrame(gpsList,columns=['Date','Height'])
-    GNSSDisp = [gpsData['Height'][0]]
-    Sum = 0 
-    j = 1
-    print(gpsData['Date'][0],xAll[0])
-    for i in range(1,len(gpsData)):
-        print(gpsData['Date'][i],xAll[j])
-        if gpsData['Date'][i] != xAll[j]:
-            Sum = Sum + gpsData['Height'][i]
-        else:
-            GNSSDisp.append(Sum)
-            Sum=0
-            j=j+1
-    print(GNSSDisp)
-    print(xAll)
+    gpsData = gnss_changes(gpsDf,start,end)
+    GNSSDisp = list(align_gnss(gpsDf,xAll)['Height']) #GNSS change between the InSAR dates
     print(len(xAll),len(GNSSDisp))
     print('Checkpoint3')
 
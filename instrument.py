@@ -0,0 +1,152 @@
+#Per stage instrumentation of the pipeline
+#Functions decorated with instrumented(stage) record their wall and cpu time, the bytes the process read and wrote
+#(/proc/self/io on linux, 0 elsewhere), the files and db rows counted with count() while they run and the gdal block cache in use.
+#The cpu time of child processes comes from os.times(), it is 0 on Windows where the children are not counted.
+#Gdal does not expose block cache hits so the cache is reported as bytes used and max at the end of each call.
+#Metrics are off by default, the decorators then only check one flag. Turn them on with enable(path) or by setting
+#ENRICHMENT_METRICS to a .json or .prom (Prometheus text) file, they are written there when the program exits.
+import atexit
+import functools
+import json
+import os
+import sys
+import threading
+import time
+
+#counters recorded for every stage
+FIELDS = ('calls','errors','wall_seconds','cpu_seconds','child_cpu_seconds','read_bytes','write_bytes','read_chars','write_chars',
+          'files_read','files_written','rows_written','gdal_cache_used_bytes','gdal_cache_max_bytes')
+
+enabled = False
+outputPath = None
+metrics = {}
+lock = threading.Lock()
+active = threading.local() #stack of the stages running on each thread, counts go to all of them
+
+
+#Turns the metrics on, they are written to path (json, or Prometheus text if it ends in .prom) when the program exits
+def enable(path=None):
+    global enabled, outputPath
+    enabled = True
+    if path is not None:
+        if outputPath is None:
+            atexit.register(lambda: outputPath and write(outputPath))
+        outputPath = path
+
+def disable():
+    global enabled
+    enabled = False
+
+def reset():
+    with lock:
+        metrics.clear()
+
+#bytes read and written by this process, rchar/wchar include reads served from the page cache
+def io_counters():
+    counters = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                name, value = line.split(':')
+                counters[name] = int(value)
+    except OSError:
+        pass
+    return counters
+
+#cpu seconds of the child processes that exited, os.times() leaves them at 0 on Windows
+def child_cpu():
+    times = os.times()
+    return times.children_user + times.children_system
+
+#bytes of the gdal block cache in use and its max, only if gdal was already imported by the pipeline
+def gdal_cache():
+    gdal = sys.modules.get('osgeo.gdal')
+    if gdal is None:
+        return None, None
+    return gdal.GetCacheUsed(), gdal.GetCacheMax()
+
+def stage_metrics(stage):
+    if stage not in metrics:
+        metrics[stage] = dict.fromkeys(FIELDS,0)
+    return metrics[stage]
+
+#Adds n to a counter (files_read, files_written or rows_written) of every stage running on this thread
+def count(name,n=1):
+    if not enabled:
+        return
+    stages = getattr(active,'stages',None)
+    if not stages:
+        return
+    with lock:
+        for stage in set(stages):
+            stage_metrics(stage)[name] += n
+
+#Decorator that records the metrics of a function under the name stage, nested stages both count the inner work
+def instrumented(stage):
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args,**kwargs):
+            if not enabled:
+                return fn(*args,**kwargs)
+            if not hasattr(active,'stages'):
+                active.stages = []
+            active.stages.append(stage)
+            io = io_counters()
+            children = child_cpu()
+            cpu = time.thread_time()
+            start = time.perf_counter()
+            failed = False
+            try:
+                return fn(*args,**kwargs)
+            except BaseException:
+                failed = True
+                raise
+            finally:
+                wall = time.perf_counter() - start
+                cpu = time.thread_time() - cpu
+                childrenAfter = child_cpu()
+                ioAfter = io_counters()
+                used, maximum = gdal_cache()
+                active.stages.pop()
+                with lock:
+                    record = stage_metrics(stage)
+                    record['calls'] += 1
+                    record['errors'] += failed
+                    record['wall_seconds'] += wall
+                    record['cpu_seconds'] += cpu
+                    #processes of the pools used by the stage, they are counted once they exit
+                    record['child_cpu_seconds'] += childrenAfter - children
+                    for name, field in (('read_bytes','read_bytes'),('write_bytes','write_bytes'),('rchar','read_chars'),('wchar','write_chars')):
+                        record[field] += ioAfter.get(name,0) - io.get(name,0)
+                    if used is not None:
+                        record['gdal_cache_used_bytes'] = max(record['gdal_cache_used_bytes'],used)
+                        record['gdal_cache_max_bytes'] = maximum
+        return wrapper
+    return decorator
+
+#copy of the metrics of every stage
+def report():
+    with lock:
+        return {stage: dict(record) for stage, record in metrics.items()}
+
+#metrics in the Prometheus text format, one metric per field labelled by stage
+def prometheus():
+    stages = report()
+    lines = []
+    for field in FIELDS:
+        name = 'enrichment_stage_'+field
+        lines.append(f"# TYPE {name} {'gauge' if field.startswith('gdal_cache') else 'counter'}")
+        for stage, record in stages.items():
+            lines.append(f'{name}{{stage="{stage}"}} {record[field]}')
+    return '\n'.join(lines)+'\n'
+
+#writes the metrics to path as json, or as Prometheus text if path ends in .prom
+def write(path):
+    with open(path,'w') as f:
+        if path.endswith('.prom'):
+            f.write(prometheus())
+        else:
+            json.dump({'time':time.time(),'pid':os.getpid(),'stages':report()},f,indent=1)
+
+if os.environ.get('ENRICHMENT_METRICS'):
+    enable(os.environ['ENRICHMENT_METRICS'])
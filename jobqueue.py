@@ -0,0 +1,285 @@
+#Local work queue to process many projects together
+#Work units (search a site, process a product, stats of a site) are rows of a SQLite queue db. Any number of worker processes,
+#on one host or on several hosts sharing a filesystem, claim units with a lease: a unit whose worker died is claimed again
+#once its lease runs out, and a failed unit is retried until it has used max_attempts.
+#The queue db keeps the default rollback journal instead of WAL because WAL needs shared memory on one host, the
+#filesystem has to support POSIX locks (a local disk, or NFS with working locks).
+#usage: python jobqueue.py enqueue-search --table Bonfouca --shp geodata/bontest.shp
+#       python jobqueue.py worker --processes 8
+import argparse
+import json
+import os
+import socket
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from multiprocessing import Process
+from zipfile import ZipFile
+
+import database
+
+#kinds of work units, see run_unit
+KINDS = ('search','process','stats')
+
+
+#opens the queue db, every statement commits on its own and claims open their own transaction
+#path:str (path to the queue .db file), timeout:float (seconds to wait for a lock)
+def connect(path,timeout=60):
+    conn = sqlite3.connect(path,timeout=timeout,isolation_level=None)
+    conn.execute(f"PRAGMA busy_timeout = {int(timeout*1000)}")
+    conn.execute("CREATE TABLE IF NOT EXISTS work_units (id integer PRIMARY KEY, kind text, project text, payload text, status text, attempts integer, max_attempts integer, available real, lease_until real, worker text, result text, error text, updated real, UNIQUE (kind, payload))")
+    conn.execute("CREATE INDEX IF NOT EXISTS work_units_claim_idx ON work_units (status, available)")
+    return conn
+
+#Adds work units to the queue, a unit already in the queue is only queued again if it failed
+#kind:str (one of KINDS), payloads:list (dicts with the arguments of the unit, they have to include db and table)
+def enqueue(conn,kind,payloads,maxAttempts=3):
+    now = time.time()
+    rows = [(kind,payload['table'],json.dumps(payload,sort_keys=True),maxAttempts,now,now) for payload in payloads]
+    conn.execute("BEGIN IMMEDIATE")
+    conn.executemany("INSERT INTO work_units (kind, project, payload, status, attempts, max_attempts, available, updated) VALUES (?, ?, ?, 'pending', 0, ?, ?, ?) "
+                     "ON CONFLICT (kind, payload) DO UPDATE SET status = 'pending', attempts = 0, available = excluded.available, error = NULL WHERE status = 'failed'",rows)
+    conn.execute("COMMIT")
+    print(str(len(rows))+" "+kind+" units queued")
+
+#Claims the oldest available unit, pending or with an expired lease, returns (id, kind, payload, token) or None if there is nothing to do
+#BEGIN IMMEDIATE takes the write lock before the select so two workers never claim the same unit
+#lease:float (seconds the unit is reserved for the worker)
+def claim(conn,lease=600):
+    now = time.time()
+    conn.execute("BEGIN IMMEDIATE")
+    try:
+        #units whose worker died on their last attempt
+        conn.execute("UPDATE work_units SET status = 'failed', error = 'lease expired', updated = ? WHERE status = 'running' AND lease_until < ? AND attempts >= max_attempts",(now,now))
+        row = conn.execute("SELECT id, kind, payload FROM work_units WHERE available <= ? AND attempts < max_attempts AND (status = 'pending' OR (status = 'running' AND lease_until < ?)) ORDER BY id LIMIT 1",(now,now)).fetchone()
+        if row is None:
+            conn.execute("COMMIT")
+            return None
+        token = socket.gethostname()+':'+str(os.getpid())+':'+uuid.uuid4().hex[:8]
+        conn.execute("UPDATE work_units SET status = 'running', attempts = attempts + 1, lease_until = ?, worker = ?, updated = ? WHERE id = ?",(now+lease,token,now,row[0]))
+        conn.execute("COMMIT")
+    except Exception:
+        conn.execute("ROLLBACK")
+        raise
+    return row[0], row[1], json.loads(row[2]), token
+
+#Extends the lease of a unit still held by the worker, returns False if the lease was lost to another worker
+def renew(conn,unitId,token,lease=600):
+    cursor = conn.execute("UPDATE work_units SET lease_until = ?, updated = ? WHERE id = ? AND worker = ? AND status = 'running'",(time.time()+lease,time.time(),unitId,token))
+    return cursor.rowcount == 1
+
+#Marks a unit done with its result, only if the worker still holds it
+def complete(conn,unitId,token,result=None):
+    conn.execute("UPDATE work_units SET status = 'done', result = ?, error = NULL, updated = ? WHERE id = ? AND worker = ?",(json.dumps(result,default=str),time.time(),unitId,token))
+
+#Records a failed attempt, the unit is retried after retryDelay seconds times the attempts so far until it used max_attempts
+def fail(conn,unitId,token,error,retryDelay=60):
+    now = time.time()
+    conn.execute("UPDATE work_units SET status = CASE WHEN attempts < max_attempts THEN 'pending' ELSE 'failed' END, "
+                 "available = ? + attempts * ?, error = ?, updated = ? WHERE id = ? AND worker = ?",(now,retryDelay,error,now,unitId,token))
+
+#Search unit: searches ASF for one site, registers its pairs and returns the jobs to send
+#Workers do not write the Parquet scene catalog, it is not safe for many processes at once
+def search_unit(conn,payload):
+    import functions
+    site = next(site for site in functions.shapefile_sites(payload['shp']) if site['name'] == payload['site'])
+    searchJson = functions.cached_search(site['geometry'].wkt,str(site['start']),str(site['end']),payload.get('cache_dir','asf_cache'),payload.get('ttl',86400))
+    scenesList = functions.get_scene_name(functions.site_scenes(searchJson,site))
+    network = functions.build_network(scenesList,payload.get('neighbours',3),payload.get('max_temporal'))
+    newPairs = functions.register_pairs([(site['name'],*row) for row in network.itertuples(index=False)],conn,payload['table'])
+    return {'jobs':functions.prepare_jobs(newPairs,payload['table'])}
+
+#tifs of a downloaded product, a zip is not extracted and its tifs are /vsizip/ paths
+def product_tifs(product):
+    import functions
+    if product.endswith('.zip'):
+        suffixes = tuple('_'+suffix+'.tif' for suffix in functions.PRODUCT_SUFFIXES)
+        with ZipFile(product) as zipf:
+            return ['/vsizip/'+product+'/'+member for member in zipf.namelist() if member.endswith(suffixes)]
+    return [os.path.join(product,file) for file in os.listdir(product) if file.endswith('.tif') and not file.endswith(("_crop.tif","_reproj.tif"))]
+
+#Process unit: unzips one product if needed, registers its InSAR name and crops/reprojects its tifs
+#The crop bounds come from the payload (the project grid in the crs of the products) so every product lands on the same grid
+def process_unit(conn,payload):
+    import functions
+    if not payload.get('bounds'):
+        raise ValueError("process units need the bounds of the project grid, queue them again with enqueue-process")
+    product = payload['product']
+    if product.endswith('.zip') and not os.path.exists(product):
+        product = os.path.splitext(product)[0] #unzipped by an earlier attempt
+    if product.endswith('.zip'):
+        tifs = functions.unzip_product((product,os.path.dirname(product),functions.PRODUCT_SUFFIXES,False))
+        folder = os.path.dirname(tifs[0]) if tifs else os.path.splitext(product)[0]
+    else:
+        folder = product
+        tifs = product_tifs(folder)
+    functions.register_insar(folder,payload['table'],conn)
+    if not tifs:
+        return {'folder':folder,'tifs':[]}
+    newcrs = str(functions.gpd.read_file(payload['shp']).crs)
+    bounds = tuple(payload['bounds'])
+    warped = [functions.warp_tif((tif,bounds,newcrs,payload.get('profile','gtiff'))) for tif in tifs]
+    functions.record_outputs(warped,conn,payload['table'])
+    functions.catalog_outputs(conn,tifs,warped,functions.output_key(bounds,newcrs,payload.get('profile','gtiff')))
+    return {'folder':folder,'tifs':warped}
+
+#Stats unit: saves the zonal stats of one site as a csv with the stats stage of the orchestrator
+def stats_unit(conn,payload):
+    import functions
+    import orchestrator
+    orchestrator.create_state_table(conn)
+    shp = functions.gpd.read_file(payload['shp'])
+    geometry = shp['geometry'][[str(name) for name in shp['Name']].index(payload['site'])]
+    orchestrator.stats_stage(conn,payload['table'],payload['site'],geometry,payload.get('stats_dir','stats'),payload.get('memory_budget'),payload.get('threshold'))
+    return {'csv':os.path.join(payload.get('stats_dir','stats'),payload['site']+'.csv')}
+
+UNITS = {'search':search_unit,'process':process_unit,'stats':stats_unit}
+
+#Runs one unit on a connection to its project db, like the queue db it keeps the rollback journal so workers on other hosts can share it
+def run_unit(kind,payload):
+    conn = database.connect(payload['db'],wal=False)
+    try:
+        database.create_project_table(conn,payload['table'])
+        return UNITS[kind](conn,payload)
+    finally:
+        conn.close()
+
+#Claims and runs units until the queue has nothing to do (or forever with wait), the lease is renewed while a unit runs
+#queuePath:str (path to the queue db), lease:float (seconds), wait:bool (keep polling for new units), pollInterval:float (seconds between polls)
+def work(queuePath,lease=600,wait=False,pollInterval=10,retryDelay=60):
+    conn = connect(queuePath)
+    done = 0
+    while True:
+        unit = claim(conn,lease)
+        if unit is None:
+            if not wait:
+                break
+            time.sleep(pollInterval)
+            continue
+        unitId, kind, payload, token = unit
+        stop = threading.Event()
+        def heartbeat():
+            heartConn = connect(queuePath)
+            while not stop.wait(lease/3):
+                if not renew(heartConn,unitId,token,lease):
+                    break
+            heartConn.close()
+        beat = threading.Thread(target=heartbeat,daemon=True)
+        beat.start()
+        try:
+            result = run_unit(kind,payload)
+        except Exception as e:
+            stop.set()
+            print(kind+" unit "+str(unitId)+" failed: "+repr(e))
+            fail(conn,unitId,token,repr(e),retryDelay)
+        else:
+            stop.set()
+            complete(conn,unitId,token,result)
+            done += 1
+        beat.join()
+    conn.close()
+    return done
+
+#Starts processes worker processes that all work on the same queue and waits for them
+def run_workers(queuePath,processes=4,lease=600,wait=False,pollInterval=10,retryDelay=60):
+    workers = [Process(target=work,args=(queuePath,lease,wait,pollInterval,retryDelay)) for x in range(processes)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+#number of units of each kind and status for every project
+def status(conn):
+    return conn.execute("SELECT project, kind, status, COUNT(*) FROM work_units GROUP BY project, kind, status ORDER BY project, kind, status").fetchall()
+
+#site names of a shapefile
+def site_names(shpPath):
+    import functions
+    return [str(name) for name in functions.gpd.read_file(shpPath)['Name']]
+
+def parser():
+    main = argparse.ArgumentParser(description="Queue work units of many projects and run them with a pool of worker processes")
+    main.add_argument('--queue',default='jobqueue.db',help="queue database")
+    commands = main.add_subparsers(dest='command',required=True)
+
+    def project(command):
+        command.add_argument('--db',default='enrichment.db',help="project database")
+        command.add_argument('--table',required=True,help="project table name")
+        command.add_argument('--shp',required=True,help="shapefile of the sites")
+        command.add_argument('--max-attempts',type=int,default=3)
+
+    command = commands.add_parser('enqueue-search',help="queue the ASF search of every site")
+    project(command)
+    command.add_argument('--cache-dir',default='asf_cache')
+    command.add_argument('--neighbours',type=int,default=3)
+    command.add_argument('--max-temporal',type=int,default=None)
+
+    command = commands.add_parser('enqueue-process',help="queue every downloaded product")
+    project(command)
+    command.add_argument('--raw',required=True,help="folder of the downloads")
+    command.add_argument('--bounds',type=float,nargs=4,default=None,help="crop bounds in the crs of the products, used if the project has no grid yet (default: bounds of the products)")
+    command.add_argument('--profile',default='gtiff')
+
+    command = commands.add_parser('enqueue-stats',help="queue the stats of every site")
+    project(command)
+    command.add_argument('--stats-dir',default='stats')
+    command.add_argument('--coherence',type=float,default=None)
+    command.add_argument('--memory-budget',type=int,default=None,help="MB per site")
+
+    command = commands.add_parser('worker',help="run worker processes until the queue is empty")
+    command.add_argument('--processes',type=int,default=os.cpu_count())
+    command.add_argument('--lease',type=float,default=600,help="seconds a claimed unit is reserved")
+    command.add_argument('--wait',action='store_true',help="keep waiting for new units")
+    command.add_argument('--poll',type=float,default=10)
+    command.add_argument('--retry-delay',type=float,default=60)
+
+    command = commands.add_parser('jobs',help="save the jobs found by the search units of a project")
+    command.add_argument('--table',required=True)
+    command.add_argument('--out',default='jobs.json')
+
+    commands.add_parser('status',help="count the units of every project")
+    return main
+
+if __name__ == '__main__':
+    args = parser().parse_args()
+    if args.command == 'worker':
+        run_workers(args.queue,args.processes,args.lease,args.wait,args.poll,args.retry_delay)
+        sys.exit()
+    conn = connect(args.queue)
+    if args.command == 'status':
+        for row in status(conn):
+            print(f"{row[0]:<20} {row[1]:<8} {row[2]:<8} {row[3]}")
+    elif args.command == 'jobs':
+        jobs = []
+        for (result,) in conn.execute("SELECT result FROM work_units WHERE kind = 'search' AND project = ? AND status = 'done' ORDER BY id",(args.table,)):
+            jobs.extend(json.loads(result)['jobs'])
+        with open(args.out,'w') as output:
+            json.dump(jobs,output)
+        print(str(len(jobs))+" jobs saved to "+args.out)
+    else:
+        base = {'db':os.path.abspath(args.db),'table':args.table,'shp':os.path.abspath(args.shp)}
+        if args.command == 'enqueue-search':
+            payloads = [dict(base,site=site,cache_dir=os.path.abspath(args.cache_dir),neighbours=args.neighbours,max_temporal=args.max_temporal) for site in site_names(args.shp)]
+            enqueue(conn,'search',payloads,args.max_attempts)
+        elif args.command == 'enqueue-process':
+            raw = os.path.abspath(args.raw)
+            names = sorted(os.listdir(raw))
+            #a folder with its zip next to it is not fully extracted, only the zip is queued
+            products = [os.path.join(raw,name) for name in names if name.endswith('.zip') or (os.path.isdir(os.path.join(raw,name)) and name+'.zip' not in names)]
+            #every product is cropped to the grid of the project, it is stored the first time from --bounds or the bounds of the products
+            bounds = None
+            if products:
+                import functions
+                newcrs = str(functions.gpd.read_file(args.shp).crs)
+                projectConn = database.connect(args.db,wal=False)
+                bounds = functions.project_grid(projectConn,args.table,newcrs,[tif for product in products for tif in product_tifs(product)],args.bounds)
+                projectConn.close()
+            payloads = [dict(base,product=product,bounds=bounds,profile=args.profile) for product in products]
+            enqueue(conn,'process',payloads,args.max_attempts)
+        elif args.command == 'enqueue-stats':
+            budget = args.memory_budget*2**20 if args.memory_budget else None
+            payloads = [dict(base,site=site,stats_dir=os.path.abspath(args.stats_dir),threshold=args.coherence,memory_budget=budget) for site in site_names(args.shp)]
+            enqueue(conn,'stats',payloads,args.max_attempts)
+    conn.close()
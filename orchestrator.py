@@ -0,0 +1,191 @@
+#Resumable orchestrator for the enrichment pipeline
+#The pipeline runs as stages: search and submit for every site, process for every product and stats for every site.
+#The state of each stage is recorded in the stage_state table of the project db, so after a crash a rerun starts from
+#the last completed stage and does no I/O for the stages that are already done. Independent sites run together in a
+#pool of threads and every db write goes through the single writer of database.ProjectDB.
+#usage: python orchestrator.py --db enrichment.db --table Bonfouca --shp geodata/bontest.shp --out Bonfouca_rawData
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import database
+import functions
+
+#stages in the order they run
+STAGES = ('search','submit','process','stats')
+
+
+#Creates the table with the state of every stage
+#conn: connection to db or ProjectDB
+def create_state_table(conn):
+    database.transaction(conn,lambda c: c.execute("CREATE TABLE IF NOT EXISTS stage_state (project text, stage text, site text, product text, status text, detail text, updated real, PRIMARY KEY (project, stage, site, product))"))
+
+#Gets the status and detail of a stage, (None, None) if it never ran
+#site and product are '' for stages that are not per site or per product
+def get_stage(conn,project,stage,site='',product=''):
+    rows = database.read(conn,"SELECT status, detail FROM stage_state WHERE project = ? AND stage = ? AND site = ? AND product = ?",(project,stage,site,product))
+    if not rows:
+        return None, None
+    return rows[0][0], json.loads(rows[0][1]) if rows[0][1] else None
+
+#Records the status of a stage (running, done or failed) and its detail (anything json can save)
+def set_stage(conn,project,stage,status,site='',product='',detail=None):
+    database.write_many(conn,"INSERT OR REPLACE INTO stage_state VALUES (?, ?, ?, ?, ?, ?, ?)",
+                        [(project,stage,site,product,status,json.dumps(detail,default=str),time.time())])
+    database.flush(conn)
+
+#Runs a stage unless it is already done, failures are recorded and raised so the site stops at that stage
+#fn: function that runs the stage and returns its detail
+def run_stage(conn,project,stage,fn,site='',product=''):
+    status, detail = get_stage(conn,project,stage,site,product)
+    if status == 'done':
+        return detail
+    try:
+        detail = fn(detail)
+    except Exception as e:
+        #keep what the stage recorded while running (like submitted job ids) so the rerun can pick it up
+        detail = get_stage(conn,project,stage,site,product)[1] or {}
+        detail['error'] = repr(e)
+        set_stage(conn,project,stage,'failed',site,product,detail)
+        raise
+    set_stage(conn,project,stage,'done',site,product,detail)
+    return detail
+
+#Search stage of a site: registers the pairs of the site and returns the jobs it needs
+def search_stage(conn,project,siteName,searchJson,catalogPath,neighbours,maxTemporal):
+    scenesList = functions.get_scene_name(searchJson,catalogPath=catalogPath)
+    network = functions.build_network(scenesList,neighbours,maxTemporal)
+    newPairs = functions.register_pairs([(siteName,*row) for row in network.itertuples(index=False)],conn,project)
+    return {'jobs':functions.prepare_jobs(newPairs,project)}
+
+#Submit stage of a site: sends its jobs once, then waits for them and downloads the products not on disk yet
+#The job ids are recorded before waiting so a rerun after a crash watches the same jobs instead of sending them again
+def submit_stage(conn,project,siteName,jobs,login,out):
+    from hyp3_sdk import HyP3, Batch
+    hyp3 = HyP3(username = login[0], password = login[1])
+    status, detail = get_stage(conn,project,'submit',siteName)
+    if status in ('running','failed') and detail and detail.get('job_ids'):
+        batch = Batch([hyp3.get_job_by_id(jobId) for jobId in detail['job_ids']])
+    elif jobs:
+        batch = hyp3.submit_prepared_jobs(prepared_jobs = jobs)
+        set_stage(conn,project,'submit','running',siteName,detail={'job_ids':[job.job_id for job in batch]})
+    else:
+        return {'job_ids':[],'products':[]}
+    if not batch.complete():
+        batch = hyp3.watch(batch)
+    products = []
+    for job in batch:
+        if not job.succeeded():
+            continue
+        for fileInfo in job.files:
+            product = os.path.splitext(fileInfo['filename'])[0]
+            products.append(product)
+            #skip products already downloaded or unzipped
+            if not os.path.exists(os.path.join(out,product)) and not os.path.exists(os.path.join(out,fileInfo['filename'])):
+                job.download_files(location = out)
+    return {'job_ids':[job.job_id for job in batch],'products':products}
+
+#Process stage: crops and reprojects the products that are not done yet, every product gets its own state
+#profile:str (layout of the outputs, key of functions.OUTPUT_PROFILES)
+def process_stage(conn,project,shpPath,out,workers,profile='gtiff'):
+    products = [name for name in os.listdir(out) if os.path.isdir(os.path.join(out,name))]
+    zipped = [name for name in os.listdir(out) if name.endswith('.zip')]
+    pending = [product for product in products if get_stage(conn,project,'process',product=product)[0] != 'done']
+    if not pending and not zipped:
+        return
+    functions.process_tifs(out,project,shpPath,conn,workers=workers,profile=profile)
+    database.flush(conn)
+    for product in [name for name in os.listdir(out) if os.path.isdir(os.path.join(out,name))]:
+        set_stage(conn,project,'process','done',product=product)
+
+#Stats stage of a site: saves the zonal stats of the site as a csv, they are only computed again when the site has new products
+#memoryBudget:int (optional bytes, see functions.get_zonal_stats), threshold:float (optional coherence threshold for the masked stats)
+def stats_stage(conn,project,siteName,geometry,statsDir,memoryBudget=None,threshold=None):
+    insars = database.read(conn,f"SELECT vertdisp_path, reference_date, coherence_path from {project} where site = ? AND vertdisp_path IS NOT NULL ORDER BY reference_date ASC",(siteName,))
+    key = hashlib.sha1(json.dumps([insars,threshold],default=str).encode()).hexdigest()
+    status, detail = get_stage(conn,project,'stats',siteName)
+    csvPath = os.path.join(statsDir,str(siteName)+'.csv')
+    if status == 'done' and detail and detail.get('key') == key and os.path.exists(csvPath):
+        return
+    coherence = [insar[2] for insar in insars] if threshold is not None else None
+    stats = functions.get_zonal_stats([insar[0] for insar in insars],geometry,memoryBudget=memoryBudget,coherence=coherence,threshold=threshold)
+    stats.insert(0,'reference_date',[insar[1] for insar in insars])
+    os.makedirs(statsDir,exist_ok=True)
+    stats.to_csv(csvPath,index=False)
+    set_stage(conn,project,'stats','done',siteName,detail={'key':key,'csv':csvPath})
+
+#Runs the whole pipeline for every site of a shapefile, resuming from the state recorded in the project db
+#dbPath:str (project db), project:str (project table name), shpPath:str, out:str (folder for the downloads), login:tuple (ASF username, password)
+#statsDir:str (folder of the stats csvs), workers:int (sites run at once), processWorkers:int (processes for cropping and reprojecting)
+#memoryBudget:int (optional bytes each site's stats may use, so many workers on large sites do not run out of memory), profile:str (layout of the processed tifs)
+#threshold:float (optional coherence threshold, the stats csvs then also have the coherence masked stats)
+def run_project(dbPath,project,shpPath,out,login,statsDir='stats',workers=4,processWorkers=None,catalogPath='scene_catalog',neighbours=3,maxTemporal=None,memoryBudget=None,profile='gtiff',threshold=None):
+    os.makedirs(out,exist_ok=True)
+    conn = database.connect(dbPath)
+    database.create_project_table(conn,project)
+    conn.close()
+    failed = {}
+    with database.ProjectDB(dbPath,project) as db:
+        create_state_table(db)
+        shp = functions.gpd.read_file(shpPath)
+        names = [str(name) for name in shp['Name']]
+
+        #search and submit, sites that still need a search share the (cached) ASF searches
+        searched = [name for name in names if get_stage(db,project,'search',name)[0] != 'done']
+        siteScenes = functions.search_sites(shpPath) if searched else {}
+
+        #the searches only touch the db and the scene catalog so they run one site at a time
+        siteJobs = {}
+        for siteName in names:
+            try:
+                siteJobs[siteName] = run_stage(db,project,'search',lambda detail: search_stage(db,project,siteName,siteScenes[siteName],catalogPath,neighbours,maxTemporal),siteName)['jobs']
+            except Exception as e:
+                failed[siteName] = e
+
+        #the sites wait on their jobs and downloads at the same time
+        def acquire(siteName):
+            try:
+                run_stage(db,project,'submit',lambda detail: submit_stage(db,project,siteName,siteJobs[siteName],login,out),siteName)
+            except Exception as e:
+                failed[siteName] = e
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(acquire,list(siteJobs)))
+
+        process_stage(db,project,shpPath,out,processWorkers,profile)
+
+        def summarize(site):
+            siteName = names[site]
+            if siteName in failed:
+                return
+            try:
+                stats_stage(db,project,siteName,shp['geometry'][site],statsDir,memoryBudget,threshold)
+            except Exception as e:
+                failed[siteName] = e
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(summarize,range(len(names))))
+
+    for siteName, error in failed.items():
+        print(siteName+" stopped: "+repr(error))
+    print(str(len(names)-len(failed))+" of "+str(len(names))+" sites done")
+    return failed
+
+if __name__ == '__main__':
+    import cli
+    main = argparse.ArgumentParser(description="Run or resume the whole pipeline for a project")
+    main.add_argument('--db',default='enrichment.db')
+    main.add_argument('--table',required=True)
+    main.add_argument('--shp',required=True)
+    main.add_argument('--out',required=True,help="folder for the downloads")
+    main.add_argument('--login',default='geodata/Login.json')
+    main.add_argument('--stats-dir',default='stats')
+    main.add_argument('--workers',type=int,default=4)
+    main.add_argument('--process-workers',type=int,default=None)
+    main.add_argument('--memory-budget',type=int,default=None,help="MB each site's stats may use")
+    main.add_argument('--profile',choices=cli.PROFILES,default='gtiff')
+    main.add_argument('--coherence',type=float,default=None,help="coherence threshold for the masked stats")
+    args = main.parse_args()
+    budget = args.memory_budget*2**20 if args.memory_budget else None
+    run_project(args.db,args.table,args.shp,args.out,cli.read_login(args.login),args.stats_dir,args.workers,args.process_workers,memoryBudget=budget,profile=args.profile,threshold=args.coherence)